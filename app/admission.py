@@ -0,0 +1,95 @@
+# app/admission.py
+"""
+Controle de admissão do nó. Com o event loop atrasado ou trabalho demais
+em andamento, o nó recusa trabalho novo (sockets e REST) em vez de deixar
+a latência subir para todo mundo; o balanceador leva a carga para outro nó.
+
+Sockets já conectados continuam sendo atendidos: só entradas novas são
+recusadas.
+"""
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from fastapi import HTTPException, status
+
+from .config import (
+    ADMISSION_INFLIGHT_MAX,
+    ADMISSION_LOOP_LAG_MAX,
+    ADMISSION_RETRY_AFTER,
+    WS_MAX_CONNECTIONS,
+    WS_MAX_CONNECTIONS_PER_ROOM,
+)
+from .metrics import ADMISSION_REJECTED, LoopLagMonitor, loop_lag_monitor
+
+
+class AdmissionControl:
+    """
+    Decide se o nó aceita trabalho novo. Os motivos de recusa são
+    "loop_lag", "inflight", "node_connections" e "room_connections".
+    Limites <= 0 ficam desligados.
+    """
+    def __init__(
+        self,
+        lag_max: float = ADMISSION_LOOP_LAG_MAX,
+        inflight_max: int = ADMISSION_INFLIGHT_MAX,
+        max_connections: int = WS_MAX_CONNECTIONS,
+        max_room_connections: int = WS_MAX_CONNECTIONS_PER_ROOM,
+        retry_after: int = ADMISSION_RETRY_AFTER,
+        monitor: LoopLagMonitor = loop_lag_monitor,
+    ):
+        self.lag_max = lag_max
+        self.inflight_max = inflight_max
+        self.max_connections = max_connections
+        self.max_room_connections = max_room_connections
+        self.retry_after = retry_after
+        self.monitor = monitor
+        # requisições REST e envios em processamento neste nó
+        self.inflight = 0
+
+    def overload_reason(self) -> Optional[str]:
+        """Motivo para recusar trabalho novo, ou None se o nó está saudável."""
+        if self.lag_max > 0 and self.monitor.lag > self.lag_max:
+            return "loop_lag"
+        if self.inflight_max > 0 and self.inflight >= self.inflight_max:
+            return "inflight"
+        return None
+
+    def connection_reason(self, node_connections: int, room_connections: int) -> Optional[str]:
+        """Como overload_reason, somando os limites de WebSockets do nó e da sala."""
+        reason = self.overload_reason()
+        if reason:
+            return reason
+        if self.max_connections > 0 and node_connections >= self.max_connections:
+            return "node_connections"
+        if self.max_room_connections > 0 and room_connections >= self.max_room_connections:
+            return "room_connections"
+        return None
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """Conta o bloco como trabalho em andamento."""
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+
+
+admission = AdmissionControl()
+
+
+async def shed_load():
+    """
+    Dependência das rotas REST: 503 com Retry-After se o nó está
+    sobrecarregado; senão conta a requisição como trabalho em andamento.
+    """
+    reason = admission.overload_reason()
+    if reason:
+        ADMISSION_REJECTED.labels("rest", reason).inc()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Servidor sobrecarregado, tente novamente.",
+            headers={"Retry-After": str(admission.retry_after)},
+        )
+    with admission.track():
+        yield
@@ -0,0 +1,108 @@
+# app/codec.py
+"""
+Codec JSON único do app: Redis, WebSocket, REST e exportação passam por
+aqui. Usa orjson quando instalado e cai para a stdlib sem ele; a saída é
+sempre compacta (sem espaços) e em UTF-8.
+
+datetime (sem timezone = UTC) vira ISO-8601 e ObjectId vira o hex, em
+qualquer lugar do payload. `message_item` é o formato único de uma
+mensagem para o cliente.
+"""
+from datetime import datetime, timezone
+from typing import Any, Optional, TypedDict, Union
+import json
+
+from bson import ObjectId
+from starlette.responses import JSONResponse as _JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende do ambiente
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def iso(dt: datetime) -> str:
+    """Converte datetime para string ISO-8601 com timezone UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.isoformat()
+
+
+def _default(value: Any):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return iso(value)
+    raise TypeError(f"Tipo não serializável em JSON: {type(value).__name__}")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NAIVE_UTC
+
+    def dumpb(value: Any) -> bytes:
+        """Serializa em JSON (bytes UTF-8)."""
+        return orjson.dumps(value, default=_default, option=_OPTIONS)
+
+    def dumps(value: Any) -> str:
+        """Serializa em JSON (str)."""
+        return orjson.dumps(value, default=_default, option=_OPTIONS).decode()
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(",", ":"), ensure_ascii=False)
+
+    def dumps(value: Any) -> str:
+        """Serializa em JSON (str)."""
+        return _encoder.encode(value)
+
+    def dumpb(value: Any) -> bytes:
+        """Serializa em JSON (bytes UTF-8)."""
+        return _encoder.encode(value).encode()
+
+    loads = json.loads
+
+
+# ---------------------------
+# Mensagens
+# ---------------------------
+class MessageItem(TypedDict):
+    """Mensagem como o cliente recebe (REST, WebSocket e cache no Redis)."""
+    id: str
+    room: str
+    username: str
+    content: str
+    avatar: Optional[str]
+    created_at: str
+
+
+def message_item(doc: dict) -> MessageItem:
+    """
+    Documento do MongoDB (ou item já serializado) → MessageItem.
+    created_at fica por último: o listener lê a idade da mensagem no fim do
+    JSON sem decodificá-lo (main._message_age).
+    """
+    created_at = doc.get("created_at")
+    return {
+        "id": str(doc.get("_id") or doc.get("id") or ""),
+        "room": doc.get("room", ""),
+        "username": doc.get("username", ""),
+        "content": doc.get("content", ""),
+        "avatar": doc.get("avatar"),
+        "created_at": iso(created_at) if isinstance(created_at, datetime) else str(created_at),
+    }
+
+
+def encode_message(doc: Union[dict, MessageItem]) -> str:
+    """message_item já serializado em JSON."""
+    return dumps(message_item(doc))
+
+
+# ---------------------------
+# HTTP
+# ---------------------------
+class JSONResponse(_JSONResponse):
+    """Resposta padrão do FastAPI, serializada pelo codec."""
+    def render(self, content: Any) -> bytes:
+        return dumpb(content)
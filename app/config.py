@@ -12,3 +12,132 @@ APP_PORT: int = int(os.getenv("APP_PORT", 8000))
 REDIS_HOST: str = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT: int = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB: int = int(os.getenv("REDIS_DB", "0"))
+
+# Redis: pool de comandos (conexões, espera (s) por uma conexão livre, timeouts
+# e intervalo do health check) e pool separado para Pub/Sub e leituras
+# bloqueantes (XREAD BLOCK), que seguram a conexão e não têm socket timeout
+REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", "200"))
+REDIS_POOL_TIMEOUT: float = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_SOCKET_TIMEOUT: float = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_CONNECT_TIMEOUT: float = float(os.getenv("REDIS_CONNECT_TIMEOUT", "2"))
+REDIS_HEALTH_CHECK_INTERVAL: int = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_PUBSUB_MAX_CONNECTIONS: int = int(os.getenv("REDIS_PUBSUB_MAX_CONNECTIONS", "10"))
+# REDIS_CLUSTER=1: REDIS_HOST/PORT é um nó de partida do Redis Cluster;
+# REDIS_SHARDED_PUBSUB=1: salas em SPUBLISH/SSUBSCRIBE (Redis 7+)
+REDIS_CLUSTER: bool = os.getenv("REDIS_CLUSTER", "0") == "1"
+REDIS_SHARDED_PUBSUB: bool = os.getenv("REDIS_SHARDED_PUBSUB", "0") == "1"
+# Streams no Cluster: intervalo (ms) entre leituras quando nada chegou
+# (XREAD não bloqueia com chaves de slots diferentes)
+ROOM_STREAM_CLUSTER_POLL_MS: int = int(os.getenv("ROOM_STREAM_CLUSTER_POLL_MS", "50"))
+
+# WebSocket: fila de saída por conexão e política para consumidores lentos
+# (drop_oldest | coalesce | disconnect)
+WS_SEND_QUEUE_MAX: int = int(os.getenv("WS_SEND_QUEUE_MAX", "256"))
+WS_SLOW_CONSUMER_POLICY: str = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+WS_SLOW_CONSUMER_CLOSE_CODE: int = int(os.getenv("WS_SLOW_CONSUMER_CLOSE_CODE", "1013"))
+# Fila cheia só conta como consumidor lento se a escritora está há mais de
+# WS_SLOW_CONSUMER_GRACE (s) sem enviar; senão é só uma rajada e a fila pode
+# crescer até WS_SEND_QUEUE_BURST × WS_SEND_QUEUE_MAX
+WS_SLOW_CONSUMER_GRACE: float = float(os.getenv("WS_SLOW_CONSUMER_GRACE", "1.0"))
+WS_SEND_QUEUE_BURST: int = int(os.getenv("WS_SEND_QUEUE_BURST", "4"))
+# Lote opcional (?batch=1): janela (s) e máximo de frames por frame "batch"
+WS_BATCH_WINDOW: float = float(os.getenv("WS_BATCH_WINDOW", "0.015"))
+WS_BATCH_MAX: int = int(os.getenv("WS_BATCH_MAX", "64"))
+# Protocolo compacto (?v=2): tamanho máximo da tabela de usuários do nó
+PROTOCOL_USER_TABLE_MAX: int = int(os.getenv("PROTOCOL_USER_TABLE_MAX", "100000"))
+
+# Pub/Sub: segundos que uma sala sem sockets locais continua inscrita
+# (evita subscribe/unsubscribe em salas com entra-e-sai frequente)
+PUBSUB_UNSUBSCRIBE_DELAY: float = float(os.getenv("PUBSUB_UNSUBSCRIBE_DELAY", "30"))
+
+# Persistência write-behind das mensagens (MESSAGE_WRITE_BEHIND=1 para ativar):
+# publica imediatamente e grava no Mongo em lotes por tamanho/tempo
+MESSAGE_WRITE_BEHIND: bool = os.getenv("MESSAGE_WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH_SIZE: int = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_FLUSH_INTERVAL: float = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.05"))
+WRITE_BEHIND_MAX_BACKLOG: int = int(os.getenv("WRITE_BEHIND_MAX_BACKLOG", "10000"))
+# 0 = tenta até gravar (o backlog cheio segura os envios); >0 descarta o lote
+# depois desse número de novas tentativas, perdendo mensagens já confirmadas
+WRITE_BEHIND_MAX_RETRIES: int = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "0"))
+WRITE_BEHIND_RETRY_MAX_DELAY: float = float(os.getenv("WRITE_BEHIND_RETRY_MAX_DELAY", "5"))
+
+# Log da sala: "pubsub" (LIST de recentes + Pub/Sub) ou "stream" (Redis Stream
+# por sala, com retomada pelo último id recebido pelo cliente)
+ROOM_LOG_BACKEND: str = os.getenv("ROOM_LOG_BACKEND", "pubsub")
+ROOM_STREAM_MAXLEN: int = int(os.getenv("ROOM_STREAM_MAXLEN", "1000"))
+ROOM_STREAM_BLOCK_MS: int = int(os.getenv("ROOM_STREAM_BLOCK_MS", "500"))
+# Maior lacuna enviada como delta na reconexão; acima disso vai o snapshot
+ROOM_STREAM_CATCHUP_MAX: int = int(os.getenv("ROOM_STREAM_CATCHUP_MAX", "500"))
+# Maior lacuna (mensagens) enviada como delta quando o cliente reconecta com since_id
+HISTORY_DELTA_MAX: int = int(os.getenv("HISTORY_DELTA_MAX", "200"))
+
+# Layout das mensagens no MongoDB: "documents" (um por mensagem, coleção messages)
+# ou "buckets" (até MESSAGE_BUCKET_SIZE por documento, coleção message_buckets)
+MESSAGE_STORAGE: str = os.getenv("MESSAGE_STORAGE", "documents")
+MESSAGE_BUCKET_SIZE: int = int(os.getenv("MESSAGE_BUCKET_SIZE", "200"))
+# Retenção (dias) via índice TTL; 0 guarda para sempre. Mudar o valor de um
+# índice TTL existente exige collMod (create_indexes não altera o índice).
+MESSAGE_RETENTION_DAYS: int = int(os.getenv("MESSAGE_RETENTION_DAYS", "0"))
+
+# Idioma do índice de texto das mensagens ("none" desliga stemming e stop words).
+# Mudar o idioma exige recriar o índice room_content_text.
+MESSAGE_SEARCH_LANGUAGE: str = os.getenv("MESSAGE_SEARCH_LANGUAGE", "portuguese")
+
+# Verificação no startup dos planos das consultas quentes: warn | fail | off
+MONGO_INDEX_CHECK: str = os.getenv("MONGO_INDEX_CHECK", "warn")
+
+# Cache local de metadados das salas (invalidado entre nós via Redis)
+ROOM_CACHE_TTL: float = float(os.getenv("ROOM_CACHE_TTL", "60"))
+ROOM_CACHE_MAX: int = int(os.getenv("ROOM_CACHE_MAX", "10000"))
+
+# Presença: janela "online" (s) e intervalo da limpeza feita pelo líder
+PRESENCE_WINDOW: int = int(os.getenv("PRESENCE_WINDOW", "60"))
+PRESENCE_SWEEP_INTERVAL: float = float(os.getenv("PRESENCE_SWEEP_INTERVAL", "10"))
+# Intervalo (s) em que cada nó grava sua presença acumulada, em lote
+PRESENCE_FLUSH_INTERVAL: float = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "5"))
+
+# Envios idempotentes (client_msg_id): segundos em que um reenvio é reconhecido
+# e tamanho do cache local de ids já aceitos
+IDEMPOTENCY_TTL: float = float(os.getenv("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_LOCAL_MAX: int = int(os.getenv("IDEMPOTENCY_LOCAL_MAX", "10000"))
+
+# Rate limit por rota: algoritmo (sliding_window | token_bucket), máximo e janela (s).
+# RATE_LIMIT_ROOM_POLICIES sobrescreve por sala, em JSON:
+# {"sala": {"ws": {"algorithm": "token_bucket", "limit": 20, "window": 10}}}
+RATE_LIMIT_WS_ALGORITHM: str = os.getenv("RATE_LIMIT_WS_ALGORITHM", "sliding_window")
+RATE_LIMIT_WS_MAX: int = int(os.getenv("RATE_LIMIT_WS_MAX", "8"))
+RATE_LIMIT_WS_WINDOW: float = float(os.getenv("RATE_LIMIT_WS_WINDOW", "5"))
+RATE_LIMIT_REST_ALGORITHM: str = os.getenv("RATE_LIMIT_REST_ALGORITHM", "sliding_window")
+RATE_LIMIT_REST_MAX: int = int(os.getenv("RATE_LIMIT_REST_MAX", "5"))
+RATE_LIMIT_REST_WINDOW: float = float(os.getenv("RATE_LIMIT_REST_WINDOW", "60"))
+RATE_LIMIT_ROOM_POLICIES: str = os.getenv("RATE_LIMIT_ROOM_POLICIES", "")
+
+# Exportação NDJSON: documentos por lote do cursor e bytes por chunk da resposta
+EXPORT_BATCH_SIZE: int = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_CHUNK_BYTES: int = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+
+# Métricas: intervalo (s) do monitor de atraso do event loop
+METRICS_LOOP_LAG_INTERVAL: float = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))
+
+# Controle de admissão (0 desliga cada limite): atraso máximo do event loop (s),
+# trabalho em andamento (requisições REST + envios), WebSockets por nó e por sala.
+# Acima disso novos sockets são fechados com ADMISSION_CLOSE_CODE e o REST
+# responde 503 com Retry-After (s)
+ADMISSION_LOOP_LAG_MAX: float = float(os.getenv("ADMISSION_LOOP_LAG_MAX", "0.25"))
+ADMISSION_INFLIGHT_MAX: int = int(os.getenv("ADMISSION_INFLIGHT_MAX", "1000"))
+WS_MAX_CONNECTIONS: int = int(os.getenv("WS_MAX_CONNECTIONS", "0"))
+WS_MAX_CONNECTIONS_PER_ROOM: int = int(os.getenv("WS_MAX_CONNECTIONS_PER_ROOM", "0"))
+ADMISSION_CLOSE_CODE: int = int(os.getenv("ADMISSION_CLOSE_CODE", "1013"))
+ADMISSION_RETRY_AFTER: int = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+# Páginas de histórico (GET /rooms/{room}/messages?before_id=): uma página
+# cujo before_id é mais antigo que HISTORY_PAGE_IMMUTABLE_AFTER (s) não muda
+# mais; é cacheada no nó (LRU por páginas e bytes) e servida com
+# Cache-Control de HISTORY_PAGE_MAX_AGE (s)
+HISTORY_PAGE_IMMUTABLE_AFTER: float = float(os.getenv("HISTORY_PAGE_IMMUTABLE_AFTER", "300"))
+HISTORY_PAGE_MAX_AGE: int = int(os.getenv("HISTORY_PAGE_MAX_AGE", "86400"))
+HISTORY_PAGE_CACHE_MAX: int = int(os.getenv("HISTORY_PAGE_CACHE_MAX", "1000"))
+HISTORY_PAGE_CACHE_BYTES: int = int(os.getenv("HISTORY_PAGE_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Com MESSAGE_RETENTION_DAYS o TTL apaga mensagens dessas páginas: sem
+# "immutable", e max-age e a vida no cache do nó ficam em no máximo isto (s)
+HISTORY_PAGE_RETENTION_MAX_AGE: int = int(os.getenv("HISTORY_PAGE_RETENTION_MAX_AGE", "60"))
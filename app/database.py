@@ -1,6 +1,18 @@
-from typing import Optional
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from .config import MONGO_URL, MONGO_DB
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from .config import (
+    MESSAGE_RETENTION_DAYS,
+    MESSAGE_SEARCH_LANGUAGE,
+    MESSAGE_STORAGE,
+    MONGO_URL,
+    MONGO_DB,
+)
+
+logger = logging.getLogger(__name__)
 
 _client: Optional[AsyncIOMotorClient] = None
 
@@ -15,3 +27,108 @@ def get_db() -> AsyncIOMotorDatabase:
             raise RuntimeError("Defina MONGO_URL no .env")
         _client = AsyncIOMotorClient(MONGO_URL)
     return _client[MONGO_DB]
+
+# ---------------------------
+# Índices
+# ---------------------------
+# Registro declarativo: create_indexes é idempotente, então roda a cada startup.
+INDEXES: Dict[str, List[IndexModel]] = {
+    # histórico por sala: find({"room"}).sort("_id") e keyset before_id/after_id
+    "messages": [
+        IndexModel([("room", ASCENDING), ("_id", ASCENDING)], name="room_id"),
+        # busca por sala: prefixo de igualdade em room, só as listas de termos da sala
+        IndexModel(
+            [("room", ASCENDING), ("content", TEXT)],
+            name="room_content_text",
+            default_language=MESSAGE_SEARCH_LANGUAGE,
+        ),
+    ],
+    "rooms": [IndexModel([("name", ASCENDING)], name="name_unique", unique=True)],
+    "profiles": [IndexModel([("created_at", DESCENDING)], name="created_at")],
+}
+
+if MESSAGE_STORAGE == "buckets":
+    INDEXES["message_buckets"] = [
+        # páginas before_id (por last_id) e after_id/exportação (por first_id)
+        IndexModel([("room", ASCENDING), ("last_id", DESCENDING)], name="room_last_id"),
+        IndexModel([("room", ASCENDING), ("first_id", ASCENDING)], name="room_first_id"),
+        # bucket aberto da sala (count < MESSAGE_BUCKET_SIZE)
+        IndexModel([("room", ASCENDING), ("count", ASCENDING)], name="room_count"),
+        IndexModel(
+            [("room", ASCENDING), ("messages.content", TEXT)],
+            name="room_content_text",
+            default_language=MESSAGE_SEARCH_LANGUAGE,
+        ),
+    ]
+
+if MESSAGE_RETENTION_DAYS > 0:
+    # o bucket expira quando a sua mensagem mais nova passa da retenção
+    _ttl_field, _ttl_coll = ("end", "message_buckets") if MESSAGE_STORAGE == "buckets" else ("created_at", "messages")
+    INDEXES[_ttl_coll].append(IndexModel(
+        [(_ttl_field, ASCENDING)], name="retention_ttl", expireAfterSeconds=MESSAGE_RETENTION_DAYS * 86400,
+    ))
+
+# Consultas quentes (coleção, filtro, ordenação) que não podem virar COLLSCAN
+HOT_QUERIES: List[Tuple[str, dict, Optional[list]]] = [
+    ("messages", {"room": ""}, [("_id", DESCENDING)]),
+    ("messages", {"room": "", "_id": {"$gt": ObjectId("0" * 24)}}, [("_id", ASCENDING)]),
+    ("messages", {"room": "", "$text": {"$search": "chat"}}, None),
+    ("rooms", {"name": ""}, None),
+    ("profiles", {}, [("created_at", DESCENDING)]),
+]
+
+if MESSAGE_STORAGE == "buckets":
+    HOT_QUERIES += [
+        ("message_buckets", {"room": "", "first_id": {"$lte": ObjectId("f" * 24)}}, [("last_id", DESCENDING)]),
+        ("message_buckets", {"room": "", "last_id": {"$gte": ObjectId("0" * 24)}}, [("first_id", ASCENDING)]),
+        ("message_buckets", {"room": "", "count": {"$lte": 0}}, None),
+    ]
+
+async def ensure_indexes():
+    """Cria os índices do registro que ainda não existem."""
+    db = get_db()
+    for name, models in INDEXES.items():
+        await db[name].create_indexes(models)
+
+def _plan_stages(plan: dict) -> Iterator[str]:
+    """Percorre os estágios de um plano do explain (clássico ou SBE)."""
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(key), dict):
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+async def check_query_plans() -> List[str]:
+    """Retorna as consultas quentes cujo plano vencedor faz COLLSCAN."""
+    db = get_db()
+    problems = []
+    for name, query, sort in HOT_QUERIES:
+        cursor = db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = await cursor.limit(1).explain()
+        winning = plan.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in set(_plan_stages(winning)):
+            problems.append(f"{name} find({query}) sort({sort})")
+    return problems
+
+async def prepare_database(check: str = "warn"):
+    """
+    Aplica os índices e confere os planos das consultas quentes.
+    check: "warn" só registra problemas, "fail" aborta o startup, "off" pula a conferência.
+    """
+    try:
+        await ensure_indexes()
+        problems = await check_query_plans() if check != "off" else []
+    except Exception:
+        if check == "fail":
+            raise
+        logger.exception("Não foi possível preparar os índices do MongoDB")
+        return
+    if problems:
+        msg = "Consultas sem índice (COLLSCAN): " + "; ".join(problems)
+        if check == "fail":
+            raise RuntimeError(msg)
+        logger.warning(msg)
@@ -0,0 +1,93 @@
+# app/export.py
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
+import zlib
+
+from bson import ObjectId
+
+from .codec import dumpb, message_item
+from .config import EXPORT_BATCH_SIZE, EXPORT_CHUNK_BYTES
+from .store import iter_messages
+
+
+def as_utc(dt: datetime) -> datetime:
+    """Datas sem timezone são tratadas como UTC."""
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def export_query(
+    room: str,
+    after_id: Optional[ObjectId] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> dict:
+    """
+    Filtro da exportação. O intervalo de tempo também limita o _id (que
+    carrega o segundo da criação), então a varredura fica no índice
+    room_id; created_at refina dentro do segundo.
+    """
+    query: dict = {"room": room}
+    bounds: dict = {}
+    created: dict = {}
+    if since is not None:
+        since = as_utc(since)
+        bounds["$gte"] = ObjectId.from_datetime(since)
+        created["$gte"] = since
+    if after_id is not None:
+        # retomada: estritamente depois do último id recebido
+        if "$gte" not in bounds or after_id >= bounds["$gte"]:
+            bounds.pop("$gte", None)
+            bounds["$gt"] = after_id
+    if until is not None:
+        until = as_utc(until)
+        bounds["$lt"] = ObjectId.from_datetime(until + timedelta(seconds=1))
+        created["$lt"] = until
+    if bounds:
+        query["_id"] = bounds
+    if created:
+        query["created_at"] = created
+    return query
+
+
+async def export_lines(
+    room: str,
+    after_id: Optional[ObjectId] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> AsyncIterator[bytes]:
+    """Uma linha NDJSON por mensagem, em ordem de _id, direto do cursor."""
+    query = export_query(room, after_id, since, until)
+    messages = iter_messages(room, query.get("_id"), query.get("created_at"), batch_size)
+    try:
+        async for doc in messages:
+            yield dumpb(message_item(doc)) + b"\n"
+    finally:
+        await messages.aclose()
+
+
+async def export_chunks(
+    lines: AsyncIterator[bytes],
+    gzip: bool = False,
+    chunk_bytes: int = EXPORT_CHUNK_BYTES,
+) -> AsyncIterator[bytes]:
+    """
+    Agrupa as linhas em chunks de ~chunk_bytes (opcionalmente gzip).
+    A memória usada não depende do tamanho da exportação.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    buf = bytearray()
+    try:
+        async for line in lines:
+            buf += line
+            if len(buf) >= chunk_bytes:
+                out = compressor.compress(bytes(buf)) if compressor else bytes(buf)
+                buf.clear()
+                if out:
+                    yield out
+    finally:
+        # cliente desconectado: fecha o cursor já, sem esperar o GC
+        await lines.aclose()
+    out = compressor.compress(bytes(buf)) + compressor.flush() if compressor else bytes(buf)
+    if out:
+        yield out
@@ -0,0 +1,222 @@
+# app/history.py
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+import asyncio
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from .codec import encode_message, loads
+from .config import HISTORY_DELTA_MAX, ROOM_LOG_BACKEND
+from .redis_client import get_redis, recent_key
+from .store import fetch_messages
+from .streams import parse_stream_id, read_room_log
+from .protocol import compact_history_frame
+from .ws_manager import history_frame
+
+# montador do frame de histórico por versão do protocolo
+HISTORY_BUILDERS = {1: history_frame, 2: compact_history_frame}
+
+HISTORY_LIMIT = 50
+
+
+def _recent_since(recent: List[str], since_id: str) -> Optional[List[str]]:
+    """
+    Itens do cache (mais novo primeiro) posteriores a since_id,
+    ou None se since_id não está no cache.
+    """
+    gap = []
+    for raw in recent:
+        try:
+            item_id = loads(raw).get("id")
+        except ValueError:
+            continue
+        if item_id == since_id:
+            return gap
+        gap.append(raw)
+    return None
+
+
+class _Ring:
+    """Últimas mensagens de uma sala, já em JSON, e o frame completo em cache por versão."""
+    __slots__ = ("entries", "frames")
+
+    def __init__(self, limit: int):
+        # (id da mensagem, id do stream ou None, item em JSON)
+        self.entries: Deque[Tuple[Optional[str], Optional[str], str]] = deque(maxlen=limit)
+        self.frames: Dict[int, str] = {}
+
+    def add(self, raw: str, stream_id: Optional[str] = None):
+        try:
+            msg_id = loads(raw).get("id")
+        except ValueError:
+            return
+        if msg_id is not None and any(e[0] == msg_id for e in self.entries):
+            return
+        self.entries.append((msg_id, stream_id, raw))
+        self.frames.clear()
+
+    def _last_stream_id(self) -> Optional[str]:
+        for _, sid, _ in reversed(self.entries):
+            if sid:
+                return sid
+        return "0-0" if ROOM_LOG_BACKEND == "stream" else None
+
+    def full_frame(self, version: int = 1) -> str:
+        frame = self.frames.get(version)
+        if frame is None:
+            build = HISTORY_BUILDERS[version]
+            frame = self.frames[version] = build((e[2] for e in self.entries), last_id=self._last_stream_id())
+        return frame
+
+    def delta_frame(self, last_id: Optional[str], since_id: Optional[str], version: int = 1) -> Optional[str]:
+        """Lacuna desde o ponto do cliente, ou None se o ring não a cobre."""
+        entries = list(self.entries)
+        if last_id and ROOM_LOG_BACKEND == "stream":
+            try:
+                last = parse_stream_id(last_id)
+            except ValueError:
+                return None
+            sids = [e for e in entries if e[1]]
+            # sem entradas de stream anteriores ao cursor não dá para provar que não há lacuna
+            if not sids or parse_stream_id(sids[0][1]) > last:
+                return None
+            gap = [e for e in sids if parse_stream_id(e[1]) > last]
+        elif since_id:
+            idx = next((i for i, e in enumerate(entries) if e[0] == since_id), None)
+            if idx is None:
+                return None
+            gap = entries[idx + 1:]
+        else:
+            return None
+        build = HISTORY_BUILDERS[version]
+        return build((e[2] for e in gap), last_id=self._last_stream_id(), delta=True)
+
+
+class RoomHistoryCache:
+    """
+    Ring buffer por sala ativa no nó com as últimas HISTORY_LIMIT mensagens.
+
+    É semeado uma vez do Redis/Mongo na primeira conexão e depois
+    alimentado pelo listener do Pub/Sub/Streams que o nó já roda; o frame
+    "history" pré-serializado só é refeito quando chega mensagem nova.
+    Conectar numa sala quente não custa Redis nem JSON. Se o listener
+    perder mensagens (reconexão do Pub/Sub), `reset` descarta os rings e
+    a próxima conexão semeia de novo.
+    """
+    def __init__(self, limit: int = HISTORY_LIMIT):
+        self.limit = limit
+        self._rings: Dict[str, _Ring] = {}
+        self._seeding: Dict[str, "asyncio.Task[_Ring]"] = {}
+        # mensagens que chegaram enquanto a sala era semeada
+        self._pending: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+        # muda a cada reset: sementes em andamento não viram ring
+        self._generation = 0
+
+    def append(self, room: str, raw: str, stream_id: Optional[str] = None):
+        """Mensagem nova recebida pelo listener da sala."""
+        ring = self._rings.get(room)
+        if ring is not None:
+            ring.add(raw, stream_id)
+        elif room in self._pending:
+            self._pending[room].append((raw, stream_id))
+
+    def drop(self, room: str):
+        """A sala deixou de ser recebida neste nó: o ring ficaria defasado."""
+        self._rings.pop(room, None)
+        self._pending.pop(room, None)
+        task = self._seeding.pop(room, None)
+        if task is not None:
+            task.cancel()
+
+    def reset(self):
+        """O listener pode ter perdido mensagens: todos os rings ficaram defasados."""
+        self._generation += 1
+        self._rings.clear()
+
+    async def get(self, room: str) -> _Ring:
+        ring = self._rings.get(room)
+        if ring is not None:
+            return ring
+        task = self._seeding.get(room)
+        if task is None:
+            self._pending[room] = []
+            task = self._seeding[room] = asyncio.ensure_future(self._seed(room))
+            task.add_done_callback(lambda _: self._seeding.pop(room, None))
+        return await asyncio.shield(task)
+
+    async def _seed(self, room: str) -> _Ring:
+        ring = _Ring(self.limit)
+        generation = self._generation
+        try:
+            if ROOM_LOG_BACKEND == "stream":
+                entries, _ = await read_room_log(room, limit=self.limit)
+                for sid, raw in entries:
+                    ring.add(raw, sid)
+            else:
+                for raw in reversed(await get_redis().lrange(recent_key(room), 0, -1)):
+                    ring.add(raw)
+            if not ring.entries:
+                for d in await fetch_messages(room, self.limit):
+                    ring.add(encode_message(d))
+            for raw, sid in self._pending.get(room, ()):
+                ring.add(raw, sid)
+        finally:
+            self._pending.pop(room, None)
+        if generation == self._generation:
+            self._rings[room] = ring
+        return ring
+
+
+history_cache = RoomHistoryCache()
+
+
+async def load_history(
+    room: str,
+    last_id: Optional[str] = None,
+    since_id: Optional[str] = None,
+    version: int = 1,
+) -> str:
+    """
+    Frame "history" enviado na conexão do WebSocket, no protocolo `version`.
+
+    Sai do ring buffer da sala (frame pré-serializado). Na reconexão só a
+    lacuna é enviada (delta): `last_id` é o último id de stream recebido
+    pelo cliente e `since_id` o id da última mensagem. Lacunas que o ring
+    não cobre vão ao Redis/MongoDB; acima de HISTORY_DELTA_MAX volta a ser
+    um snapshot completo.
+    """
+    ring = await history_cache.get(room)
+    if not (last_id or since_id):
+        return ring.full_frame(version)
+    frame = ring.delta_frame(last_id, since_id, version)
+    if frame is not None:
+        return frame
+    return await _load_delta(room, last_id, since_id, version) or ring.full_frame(version)
+
+
+async def _load_delta(room: str, last_id: Optional[str], since_id: Optional[str], version: int) -> Optional[str]:
+    """Lacuna maior que o ring: Stream/LIST do Redis e depois MongoDB."""
+    build = HISTORY_BUILDERS[version]
+    if ROOM_LOG_BACKEND == "stream":
+        if last_id:
+            entries, delta = await read_room_log(room, last_id, limit=HISTORY_LIMIT)
+            if delta:
+                cursor = entries[-1][0] if entries else last_id
+                return build((m for _, m in entries), last_id=cursor, delta=True)
+        return None
+
+    if not since_id:
+        return None
+    recent = await get_redis().lrange(recent_key(room), 0, -1)
+    gap = _recent_since(recent, since_id) if recent else None
+    if gap is not None:
+        return build(reversed(gap), delta=True)
+    try:
+        after = ObjectId(since_id)
+    except (InvalidId, TypeError):
+        return None
+    docs = await fetch_messages(room, HISTORY_DELTA_MAX + 1, after_id=after)
+    if len(docs) > HISTORY_DELTA_MAX:
+        return None
+    return build((encode_message(d) for d in docs), delta=True)
@@ -0,0 +1,192 @@
+# app/ingest.py
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+import time
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from .codec import dumps, loads, message_item
+from .config import (
+    IDEMPOTENCY_LOCAL_MAX,
+    IDEMPOTENCY_TTL,
+    MESSAGE_WRITE_BEHIND,
+    ROOM_LOG_BACKEND,
+    ROOM_STREAM_MAXLEN,
+)
+from .metrics import MESSAGE_RESULTS, SEND_STAGES
+from .models import MessageIn
+from .persistence import message_writer
+from .presence import presence_buffer
+from .redis_client import (
+    INGEST_ACCEPTED,
+    INGEST_DUPLICATE,
+    idempotency_key,
+    ingest_recent,
+    ingest_stream,
+    rate_limit_key,
+)
+from .store import insert_message
+from .utils.rate_limit import get_policy, local_limiter
+
+RECENT_MAXLEN = 50
+
+
+class RecentClientIds:
+    """
+    client_msg_ids aceitos neste nó nos últimos `ttl` segundos (LRU).
+    Um reenvio pelo mesmo nó é respondido sem ir ao Redis; entre nós a
+    deduplicação fica com a chave de idempotência no script de ingestão.
+    `persisted` é False quando o item foi publicado mas a gravação falhou.
+    """
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_size: int = IDEMPOTENCY_LOCAL_MAX):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._items: "OrderedDict[str, Tuple[float, dict, bool]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[dict, bool]]:
+        """(item, persisted), ou None se o client_msg_id não é conhecido."""
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        expires, item, persisted = entry
+        if expires < time.monotonic():
+            self._items.pop(key, None)
+            return None
+        return item, persisted
+
+    def add(self, key: str, item: dict, persisted: bool = True):
+        self._items[key] = (time.monotonic() + self.ttl, item, persisted)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+recent_client_ids = RecentClientIds()
+
+
+def _message_doc(room: str, item: dict) -> dict:
+    """Documento do MongoDB a partir do item já publicado (mesmo _id)."""
+    return {
+        "_id": ObjectId(item["id"]),
+        "room": room,
+        "username": item.get("username", ""),
+        "avatar": item.get("avatar"),
+        "content": item.get("content", ""),
+        "created_at": datetime.fromisoformat(item["created_at"]),
+    }
+
+
+async def _persist_again(room: str, idem_key: str, item: dict):
+    """
+    Reenvio de um item que talvez não tenha sido gravado: grava o mesmo
+    _id antes do ack. Chave duplicada significa que já estava gravado.
+    """
+    try:
+        await insert_message(_message_doc(room, item))
+    except DuplicateKeyError:
+        pass
+    recent_client_ids.add(idem_key, item)
+
+
+async def ingest_message(
+    room: str,
+    message: MessageIn,
+    route: str,
+) -> Optional[dict]:
+    """
+    Caminho único de envio (WebSocket e REST); `route` escolhe a
+    política de rate limit. Floods óbvios são recusados pela pré-checagem
+    local, sem tocar no Redis.
+
+    O _id é gerado aqui para que o item já possa ir para o Redis
+    (rate limit e recentes + Pub/Sub ou Stream em um único round trip;
+    a presença do autor vai para o buffer do nó)
+    antes da gravação no MongoDB. Com MESSAGE_WRITE_BEHIND a gravação
+    vai para o MessageWriter e não fica no caminho do envio.
+
+    Com `client_msg_id` o envio é idempotente: um reenvio devolve o item
+    aceito da primeira vez, sem publicar de novo. Se a gravação falhar o
+    erro é propagado (sem ack), mas o item já foi publicado: a chave de
+    idempotência fica e o reenvio do cliente grava o mesmo _id antes do
+    ack, em vez de virar uma segunda mensagem na sala.
+    Retorna o item serializado, ou None se o rate limit foi excedido.
+    """
+    stages = SEND_STAGES[route]
+    results = MESSAGE_RESULTS[route]
+    t0 = time.perf_counter()
+    idem_key = None
+    if message.client_msg_id:
+        idem_key = idempotency_key(room, message.username, message.client_msg_id)
+        previous = recent_client_ids.get(idem_key)
+        if previous is not None:
+            item, persisted = previous
+            if not persisted:
+                await _persist_again(room, idem_key, item)
+            results.duplicate.inc()
+            return item
+    policy = get_policy(route, room)
+    rate_key = rate_limit_key(room, message.username, route)
+    if not local_limiter.allows(rate_key, policy):
+        stages.rate_limit.observe(time.perf_counter() - t0)
+        results.rate_limited.inc()
+        return None
+    t1 = time.perf_counter()
+    stages.rate_limit.observe(t1 - t0)
+
+    doc = {
+        "_id": ObjectId(),
+        "room": room,
+        "username": message.username,
+        "avatar": message.avatar,
+        # strip único para WebSocket e REST
+        "content": message.content.strip(),
+        "created_at": datetime.now(timezone.utc),
+    }
+    serial = message_item(doc)
+
+    item = dumps(serial)
+    member = str(doc["_id"])
+    if ROOM_LOG_BACKEND == "stream":
+        status, value = await ingest_stream(
+            room, rate_key, policy, member, item, maxlen=ROOM_STREAM_MAXLEN,
+            idem_key=idem_key, idem_ttl=IDEMPOTENCY_TTL,
+        )
+    else:
+        status, value = await ingest_recent(
+            room, rate_key, policy, member, item, maxlen=RECENT_MAXLEN,
+            idem_key=idem_key, idem_ttl=IDEMPOTENCY_TTL,
+        )
+    t2 = time.perf_counter()
+    stages.redis.observe(t2 - t1)
+    if status == INGEST_DUPLICATE:
+        # reenvio aceito antes (talvez por outro nó): devolve o item original
+        previous = loads(value)
+        if MESSAGE_WRITE_BEHIND:
+            recent_client_ids.add(idem_key, previous)
+        else:
+            # a gravação do envio original pode ter falhado (aqui ou em outro nó)
+            await _persist_again(room, idem_key, previous)
+        results.duplicate.inc()
+        return previous
+    if status != INGEST_ACCEPTED:
+        results.rate_limited.inc()
+        return None
+    local_limiter.record(rate_key, policy)
+    presence_buffer.touch(room, message.username)
+
+    try:
+        if MESSAGE_WRITE_BEHIND:
+            await message_writer.enqueue(doc)
+        else:
+            await insert_message(doc)
+    except Exception:
+        if idem_key:
+            recent_client_ids.add(idem_key, serial, persisted=False)
+        raise
+    if idem_key:
+        recent_client_ids.add(idem_key, serial)
+    stages.mongo.observe(time.perf_counter() - t2)
+    results.accepted.inc()
+    return serial
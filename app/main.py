@@ -2,26 +2,51 @@ from __future__ import annotations
 from pathlib import Path
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime, timezone
+from datetime import datetime
 import asyncio
-import json
 import time
 
-from .config import APP_HOST, APP_PORT
-from .database import get_db
-from .models import MessageIn, serialize
+from .admission import admission
+from .codec import JSONResponse, loads
+from .config import (
+    ADMISSION_CLOSE_CODE,
+    APP_HOST,
+    APP_PORT,
+    MESSAGE_WRITE_BEHIND,
+    MONGO_INDEX_CHECK,
+    ROOM_LOG_BACKEND,
+)
+from .database import prepare_database
+from .history import history_cache, load_history
+from .ingest import ingest_message
+from .metrics import (
+    ADMISSION_REJECTED,
+    CONTENT_TYPE,
+    LISTENER_LAG_SECONDS,
+    REGISTRY,
+    SEND_STAGES,
+    loop_lag_monitor,
+    render_metrics,
+)
+from .models import MessageIn
+from .persistence import message_writer
+from .pubsub import RoomSubscriptions
+from .room_cache import room_cache_listener
+from .streams import RoomStreams
+from .utils.rate_limit import get_policy
 from .ws_manager import WSManager
 from .routes import messages as messages_router
 from .routes import rooms as rooms_router
 from .routes import users as users_router
-from .redis_client import get_redis, publish_message, push_recent
+from .presence import presence_buffer, presence_sweeper
+from .redis_client import close_redis, get_redis
 
 ROOT = Path(__file__).resolve().parents[1]
 STATIC_DIR = ROOT / "static"
 
-app = FastAPI(title="FastAPI Chat (Grupos + Perfis)")
+app = FastAPI(title="FastAPI Chat (Grupos + Perfis)", default_response_class=JSONResponse)
 
 # ---------------------------
 # Middlewares
@@ -42,20 +67,43 @@ app.include_router(messages_router.router)
 app.include_router(rooms_router.router)
 app.include_router(users_router.router)
 
-manager = WSManager()
-
-# ---------------------------
-# Configs
-# ---------------------------
-PRESENCE_WINDOW = 60       # segundos considerados "online"
-RATE_LIMIT_WINDOW = 5      # janela rate-limit em segundos
-RATE_LIMIT_MAX = 8         # mensagens por janela
+# Fonte das mensagens das salas locais: Pub/Sub ou Redis Streams
+subscriptions = RoomStreams() if ROOM_LOG_BACKEND == "stream" else RoomSubscriptions()
+manager = WSManager(subscriptions=subscriptions)
+# ring buffer de histórico some junto com a inscrição da sala
+subscriptions.on_deactivate = history_cache.drop
+# mensagens perdidas numa queda do listener: os rings são semeados de novo
+subscriptions.on_reset = history_cache.reset
+# presença derivada dos sockets vivos deste nó
+presence_buffer.live_users = manager.live_users
+
+# Métricas lidas no scrape a partir do estado que já existe
+REGISTRY.collector(
+    "chat_ws_connections", "WebSockets abertos neste nó por sala", "gauge",
+    lambda: (("chat_ws_connections", {"room": room}, len(conns)) for room, conns in list(manager.rooms.items())),
+)
+REGISTRY.collector(
+    "chat_ws_queued_frames", "Frames aguardando envio neste nó", "gauge",
+    lambda: [("chat_ws_queued_frames", {}, sum(manager.queue_depth(room) for room in list(manager.rooms)))],
+)
+REGISTRY.collector(
+    "chat_inflight_work", "Requisições REST e envios em processamento neste nó", "gauge",
+    lambda: [("chat_inflight_work", {}, admission.inflight)],
+)
+REGISTRY.collector(
+    "chat_write_behind_backlog", "Mensagens aguardando gravação no MongoDB", "gauge",
+    lambda: [("chat_write_behind_backlog", {}, message_writer.backlog)],
+)
+WS_STAGES = SEND_STAGES["ws"]
 
 # ---------------------------
 # Background tasks
 # ---------------------------
 _pubsub_task: asyncio.Task | None = None
-_presence_cleaner_task: asyncio.Task | None = None
+_presence_sweeper_task: asyncio.Task | None = None
+_presence_flush_task: asyncio.Task | None = None
+_room_cache_task: asyncio.Task | None = None
+_loop_lag_task: asyncio.Task | None = None
 
 # ---------------------------
 # Redis utils
@@ -73,177 +121,162 @@ async def wait_redis_ready(timeout: int = 10):
                 raise TimeoutError("Redis não disponível após espera")
             await asyncio.sleep(0.5)
 
-async def redis_pubsub_listener():
-    """Recebe mensagens via pubsub e retransmite para WSManager"""
-    r = get_redis()
-    pubsub = r.pubsub()
-    await pubsub.psubscribe("chat:*")
+_CREATED_AT = '"created_at":'
+
+def _message_age(data: str, stream_id: str | None) -> float | None:
+    """
+    Idade da mensagem ao chegar no listener: pelo id do stream (relógio do
+    Redis) ou pelo created_at no fim do item, sem decodificar o JSON.
+    """
+    if stream_id:
+        return time.time() - int(stream_id.partition("-")[0]) / 1000
+    start = data.rfind(_CREATED_AT)
+    if start < 0:
+        return None
+    # aceita itens antigos, serializados com espaço depois dos dois-pontos
+    start = data.find('"', start + len(_CREATED_AT)) + 1
+    if start <= 0:
+        return None
     try:
-        async for message in pubsub.listen():
-            if message.get("type") not in ("message", "pmessage"):
-                continue
-
-            channel = message.get("channel")
-            if isinstance(channel, bytes):
-                channel = channel.decode()
-
-            if not channel.startswith("chat:"):
-                continue
+        return time.time() - datetime.fromisoformat(data[start:data.find('"', start)]).timestamp()
+    except ValueError:
+        return None
 
-            room = channel.split(":", 1)[1]
-            data = message.get("data")
-
-            try:
-                if isinstance(data, (bytes, bytearray)):
-                    data = data.decode()
-                payload = json.loads(data)
-            except Exception:
-                continue
-
-            await manager.broadcast(room, {"type": "message", "item": payload})
+async def redis_pubsub_listener():
+    """Recebe mensagens das salas com sockets locais e retransmite para WSManager"""
+    async def on_message(room: str, data: str, stream_id: str | None):
+        age = _message_age(data, stream_id)
+        if age is not None:
+            LISTENER_LAG_SECONDS.observe(max(0.0, age))
+        # O payload publicado já é o item em JSON: envelopa sem decodificar
+        history_cache.append(room, data, stream_id)
+        await manager.broadcast_message(room, data, stream_id)
+        # broadcast só enfileira: cede o loop para as escritoras drenarem as
+        # filas durante rajadas do listener, em vez de acumular tudo antes
+        await asyncio.sleep(0)
 
-    except asyncio.CancelledError:
-        await pubsub.punsubscribe()
-        await pubsub.close()
-        raise
+    try:
+        await subscriptions.listen(on_message)
     finally:
-        try:
-            await pubsub.punsubscribe()
-            await pubsub.close()
-        except Exception:
-            pass
-
-async def presence_cleaner():
-    """Remove usuários antigos dos ZSETs de presença"""
-    r = get_redis()
-    while True:
-        try:
-            now = int(time.time())
-            keys = await r.keys("chat:*:presence")
-            for key in keys:
-                await r.zremrangebyscore(key, 0, now - PRESENCE_WINDOW)
-        except Exception:
-            pass
-        await asyncio.sleep(10)
+        await subscriptions.close()
 
 # ---------------------------
 # Startup / Shutdown
 # ---------------------------
 @app.on_event("startup")
 async def startup_event():
-    global _pubsub_task, _presence_cleaner_task
+    global _pubsub_task, _presence_sweeper_task, _presence_flush_task, _room_cache_task, _loop_lag_task
     await wait_redis_ready()
+    await prepare_database(MONGO_INDEX_CHECK)
     loop = asyncio.get_event_loop()
     _pubsub_task = loop.create_task(redis_pubsub_listener())
-    _presence_cleaner_task = loop.create_task(presence_cleaner())
+    _presence_sweeper_task = loop.create_task(presence_sweeper())
+    _presence_flush_task = loop.create_task(presence_buffer.run())
+    _room_cache_task = loop.create_task(room_cache_listener())
+    _loop_lag_task = loop.create_task(loop_lag_monitor.run())
+    if MESSAGE_WRITE_BEHIND:
+        message_writer.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    global _pubsub_task, _presence_cleaner_task
+    global _pubsub_task, _presence_sweeper_task, _presence_flush_task, _room_cache_task, _loop_lag_task
     if _pubsub_task:
         _pubsub_task.cancel()
         try:
             await _pubsub_task
         except:
             pass
-    if _presence_cleaner_task:
-        _presence_cleaner_task.cancel()
+    if _presence_sweeper_task:
+        _presence_sweeper_task.cancel()
         try:
-            await _presence_cleaner_task
+            await _presence_sweeper_task
         except:
             pass
-    r = get_redis()
-    try:
-        await r.close()
-    except Exception:
-        pass
-
-# ---------------------------
-# Rate-limit
-# ---------------------------
-async def check_rate_limit(room: str, username: str) -> bool:
-    r = get_redis()
-    key = f"rl:{room}:{username}"
-    val = await r.incr(key)
-    if val == 1:
-        await r.expire(key, RATE_LIMIT_WINDOW)
-    return val <= RATE_LIMIT_MAX
+    if _presence_flush_task:
+        _presence_flush_task.cancel()
+        try:
+            await _presence_flush_task
+        except:
+            pass
+    if _room_cache_task:
+        _room_cache_task.cancel()
+        try:
+            await _room_cache_task
+        except:
+            pass
+    if _loop_lag_task:
+        _loop_lag_task.cancel()
+        try:
+            await _loop_lag_task
+        except:
+            pass
+    # Grava no Mongo o que ainda estiver na fila write-behind
+    await message_writer.stop()
+    await close_redis()
 
 # ---------------------------
 # WebSocket Handler
 # ---------------------------
 @app.websocket("/ws/{room}")
 async def ws_room(ws: WebSocket, room: str):
-    await manager.connect(room, ws)
-    r = get_redis()
+    params = ws.query_params
+    # ?batch=1: o cliente aceita frames {"type":"batch"} em rajadas;
+    # ?v=2: protocolo compacto (app/protocol.py)
+    version = 2 if params.get("v") == "2" else 1
+
+    # Nó sobrecarregado ou cheio: fecha com código "tente depois" (1013)
+    reason = admission.connection_reason(manager.connection_count(), manager.connection_count(room))
+    if reason:
+        ADMISSION_REJECTED.labels("ws", reason).inc()
+        await ws.accept()
+        await ws.close(code=ADMISSION_CLOSE_CODE, reason=reason)
+        return
+
+    await manager.connect(room, ws, batch=params.get("batch") == "1", version=version)
     try:
-        # Histórico (Redis ou Mongo)
-        recent_key = f"chat:{room}:recent"
-        recent = await r.lrange(recent_key, 0, -1)
-        items = []
-
-        if recent:
-            for raw in reversed(recent):
-                try:
-                    items.append(json.loads(raw))
-                except Exception:
-                    pass
-        else:
-            cursor = get_db()["messages"].find({"room": room}).sort("_id", -1).limit(50)
-            async for d in cursor:
-                items.append(serialize(d))
-            items.reverse()
-
-        await ws.send_json({"type": "history", "items": items})
-
-        presence_key = f"chat:{room}:presence"
+        # Histórico (Redis ou Mongo); last_id/since_id retomam do ponto do cliente
+        frame = await load_history(room, params.get("last_id"), params.get("since_id"), version)
+        manager.send_frame(ws, frame)
 
         while True:
-            payload = await ws.receive_json()
+            payload = loads(await ws.receive_text())
 
-            # Heartbeat → atualiza presença
+            # Heartbeat → identifica o usuário do socket (presença sai do buffer do nó)
             if isinstance(payload, dict) and payload.get("type") == "heartbeat":
-                user = payload.get("username", "anon")
-                await r.zadd(presence_key, {user: int(time.time())})
+                manager.set_user(ws, str(payload.get("username") or "anon")[:50])
                 continue
 
             # Validação da mensagem
+            t0 = time.perf_counter()
             try:
                 m = MessageIn(**payload)
             except Exception:
                 continue
+            finally:
+                WS_STAGES.validation.observe(time.perf_counter() - t0)
 
             if not m.content.strip():
                 continue
-
-            # Rate limit
-            allowed = await check_rate_limit(room, m.username)
-            if not allowed:
-                await ws.send_json({
-                    "type": "error",
-                    "detail": f"Rate limit: max {RATE_LIMIT_MAX} msgs / {RATE_LIMIT_WINDOW}s"
-                })
+            manager.set_user(ws, m.username)
+
+            # Rate limit, cache no Redis, Pub/Sub, presença e Mongo
+            with admission.track():
+                serial = await ingest_message(room, m, "ws")
+            if serial is None:
+                error = {"type": "error", "detail": get_policy("ws", room).describe()}
+                if m.client_msg_id:
+                    error["client_msg_id"] = m.client_msg_id
+                manager.send(ws, error)
                 continue
 
-            # Persiste no Mongo
-            doc = {
-                "room": room,
-                "username": m.username,
-                "avatar": m.avatar,
-                "content": m.content,
-                "created_at": datetime.now(timezone.utc),
-            }
-            res = await get_db()["messages"].insert_one(doc)
-            doc["_id"] = res.inserted_id
-            serial = serialize(doc)
-
-            # Cache no Redis e Pub/Sub
-            await push_recent(room, serial, maxlen=50)
-            await publish_message(room, serial)
-            await r.zadd(presence_key, {m.username: int(time.time())})
-
-            # Retorna ao remetente
-            await ws.send_json({"type": "message", "item": serial})
+            # Confirma ao remetente: ack para quem manda client_msg_id,
+            # eco do item para clientes antigos
+            t0 = time.perf_counter()
+            if m.client_msg_id:
+                manager.send_ack(ws, m.client_msg_id, serial.get("id"))
+            else:
+                manager.send_item(ws, serial)
+            WS_STAGES.echo.observe(time.perf_counter() - t0)
 
     except WebSocketDisconnect:
         manager.disconnect(room, ws)
@@ -254,6 +287,16 @@ async def ws_room(ws: WebSocket, room: str):
 # ---------------------------
 # Rotas simples
 # ---------------------------
+@app.get("/ws/stats")
+async def ws_stats():
+    """Conexões e profundidade das filas de envio por sala neste nó"""
+    return {"rooms": manager.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas deste nó no formato texto do Prometheus"""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
 @app.get("/chat")
 async def get_chat():
     return FileResponse("app/static/chat.html")
@@ -0,0 +1,269 @@
+# app/metrics.py
+"""
+Métricas no formato texto do Prometheus, sem dependências externas.
+
+Os filhos com labels são resolvidos uma vez (`labels(...)`) e guardados
+em variáveis de módulo; no caminho quente só há `inc`/`observe`, sem
+montar dicts ou tuplas de labels por mensagem. Valores que já existem em
+outro lugar (conexões por sala, backlog) são lidos na hora do scrape por
+coletores.
+"""
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+import asyncio
+import logging
+
+from .config import METRICS_LOOP_LAG_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Buckets (s) pensados para etapas de milissegundos
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# coletor: devolve (nome, labels, valor) lidos na hora do scrape
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Filho para os valores de label; chame uma vez e guarde o resultado."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} espera labels {self.labelnames}")
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} exige labels()")
+        return self._children[()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> Iterable[str]:
+        yield f"{self.name}{_labels_text(self.labelnames, values)} {_number(child.value)}"
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, doc, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def _render_child(self, values, child) -> Iterable[str]:
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += n
+            le = 'le="' + _number(bound) + '"'
+            yield f"{self.name}_bucket{_labels_text(self.labelnames, values, le)} {cumulative}"
+        labels = _labels_text(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_number(child.sum)}"
+        yield f"{self.name}_count{labels} {child.count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Tuple[str, str, str, Callable[[], Iterable[Sample]]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, name: str, doc: str, kind: str, fn: Callable[[], Iterable[Sample]]):
+        """Métrica calculada no scrape; fn devolve (nome, labels, valor)."""
+        self._collectors.append((name, doc, kind, fn))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, doc, kind, fn in self._collectors:
+            lines += [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"]
+            try:
+                for sample_name, labels, value in fn():
+                    text = _labels_text(tuple(labels), tuple(labels.values()))
+                    lines.append(f"{sample_name}{text} {_number(value)}")
+            except Exception:
+                logger.warning("Falha no coletor de métricas %s", name, exc_info=True)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ---------------------------
+# Métricas do chat
+# ---------------------------
+MESSAGES = REGISTRY.register(Counter(
+    "chat_messages_total", "Mensagens recebidas por rota e resultado", ("route", "result")))
+SEND_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "chat_send_stage_seconds", "Duração de cada etapa do envio de mensagem", ("route", "stage")))
+LISTENER_LAG_SECONDS = REGISTRY.register(Histogram(
+    "chat_listener_lag_seconds",
+    "Atraso entre a criação da mensagem e sua chegada ao listener do nó (inclui diferença de relógio)",
+    buckets=LATENCY_BUCKETS + (5.0, 10.0)))
+BROADCAST_SECONDS = REGISTRY.register(Histogram(
+    "chat_broadcast_seconds", "Duração do fan-out de uma mensagem para os sockets locais"))
+BROADCAST_FAILURES = REGISTRY.register(Counter(
+    "chat_broadcast_failures_total", "Frames não entregues por motivo", ("reason",)))
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram(
+    "chat_event_loop_lag_seconds", "Atraso do event loop medido pelo monitor",
+    buckets=LATENCY_BUCKETS + (5.0,)))
+LOOP_LAG = REGISTRY.register(Gauge(
+    "chat_event_loop_lag_last_seconds", "Último atraso medido do event loop"))
+HISTORY_PAGES = REGISTRY.register(Counter(
+    "chat_history_pages_total", "Páginas de histórico do REST por origem (cache do nó ou banco)", ("source",)))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "chat_admission_rejected_total", "Trabalho novo recusado pelo controle de admissão", ("kind", "reason")))
+
+
+class SendStages(NamedTuple):
+    """Filhos pré-resolvidos de chat_send_stage_seconds para uma rota."""
+    validation: _HistogramChild
+    rate_limit: _HistogramChild
+    redis: _HistogramChild
+    mongo: _HistogramChild
+    echo: _HistogramChild
+
+
+class MessageResults(NamedTuple):
+    accepted: _Value
+    rate_limited: _Value
+    duplicate: _Value
+
+
+SEND_STAGES = {
+    route: SendStages(*(SEND_STAGE_SECONDS.labels(route, stage) for stage in SendStages._fields))
+    for route in ("ws", "rest")
+}
+MESSAGE_RESULTS = {
+    route: MessageResults(*(MESSAGES.labels(route, result) for result in MessageResults._fields))
+    for route in ("ws", "rest")
+}
+BROADCAST_DROPPED = BROADCAST_FAILURES.labels("dropped")
+BROADCAST_SEND_ERROR = BROADCAST_FAILURES.labels("send_error")
+HISTORY_PAGES_CACHED = HISTORY_PAGES.labels("cache")
+HISTORY_PAGES_QUERIED = HISTORY_PAGES.labels("db")
+
+
+class LoopLagMonitor:
+    """
+    Mede o atraso do event loop: dorme `interval` e compara com o tempo
+    que realmente passou. `lag` guarda a última medida.
+    """
+    def __init__(self, interval: float = METRICS_LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            LOOP_LAG.set(self.lag)
+            LOOP_LAG_SECONDS.observe(self.lag)
+
+
+loop_lag_monitor = LoopLagMonitor()
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
+
@@ -1,6 +1,5 @@
 # app/models.py
 from pydantic import BaseModel, Field, validator
-from datetime import datetime, timezone
 from typing import Optional
 from bson import ObjectId
 from fastapi import APIRouter, HTTPException
@@ -23,23 +22,6 @@ class PyObjectId(ObjectId):
         except Exception:
             raise ValueError("Invalid ObjectId")
 
-def iso(dt: datetime) -> str:
-    """Converte datetime para string ISO-8601 com timezone UTC."""
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.isoformat()
-
-def serialize(doc: dict) -> dict:
-    """Serializa documentos MongoDB em JSON-safe."""
-    return {
-        "id": str(doc["_id"]),
-        "room": doc["room"],
-        "username": doc["username"],
-        "content": doc["content"],
-        "avatar": doc.get("avatar"),
-        "created_at": iso(doc["created_at"]),
-    }
-
 # ---------------------------
 # Router e Mock DB
 # ---------------------------
@@ -90,6 +72,8 @@ class MessageIn(BaseModel):
     username: str = Field(..., min_length=1, max_length=50)
     content: str = Field(..., min_length=1, max_length=1000)
     avatar: Optional[str] = None
+    # id gerado pelo cliente: reenvios com o mesmo id não duplicam a mensagem
+    client_msg_id: Optional[str] = Field(None, max_length=64)
 
     @validator("username", pre=True, always=True)
     def clean_username(cls, v):
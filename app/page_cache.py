@@ -0,0 +1,120 @@
+# app/page_cache.py
+"""
+Cache das páginas de histórico do REST (rolagem para trás).
+
+Uma página `before_id` só contém mensagens anteriores ao cursor; passado
+HISTORY_PAGE_IMMUTABLE_AFTER desde o instante do ObjectId (folga para o
+write-behind e relógios dos nós) nada mais entra nela. Essas páginas são
+guardadas já serializadas num LRU e servidas com ETag forte e
+Cache-Control longo, para o navegador/CDN absorverem a rolagem.
+
+Com MESSAGE_RETENTION_DAYS o índice TTL remove mensagens de páginas
+antigas a qualquer momento: elas deixam de ser "immutable" e tanto o
+max-age quanto a vida no LRU caem para HISTORY_PAGE_RETENTION_MAX_AGE.
+"""
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+import hashlib
+import time
+
+from bson import ObjectId
+
+from .config import (
+    HISTORY_PAGE_CACHE_BYTES,
+    HISTORY_PAGE_CACHE_MAX,
+    HISTORY_PAGE_IMMUTABLE_AFTER,
+    HISTORY_PAGE_MAX_AGE,
+    HISTORY_PAGE_RETENTION_MAX_AGE,
+    MESSAGE_RETENTION_DAYS,
+)
+
+# (sala, before_id, limit)
+PageKey = Tuple[str, str, int]
+
+if MESSAGE_RETENTION_DAYS > 0:
+    # segundos que uma página fica no cache do nó
+    PAGE_TTL: Optional[float] = min(HISTORY_PAGE_MAX_AGE, HISTORY_PAGE_RETENTION_MAX_AGE)
+    IMMUTABLE_CACHE_CONTROL = f"public, max-age={int(PAGE_TTL)}"
+else:
+    PAGE_TTL = None
+    IMMUTABLE_CACHE_CONTROL = f"public, max-age={HISTORY_PAGE_MAX_AGE}, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def page_etag(body: bytes) -> str:
+    """ETag forte: hash do corpo serializado."""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match (lista separada por vírgulas, "*" ou W/) casa com `etag`."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def is_immutable(before_id: Optional[ObjectId], now: Optional[datetime] = None) -> bool:
+    """A página anterior a `before_id` não recebe mais mensagens."""
+    if before_id is None:
+        return False
+    now = now or datetime.now(timezone.utc)
+    return (now - before_id.generation_time).total_seconds() > HISTORY_PAGE_IMMUTABLE_AFTER
+
+
+class HistoryPageCache:
+    """
+    LRU de páginas imutáveis já serializadas: (corpo, ETag) por
+    (sala, before_id, limit), limitado em páginas e em bytes. Com `ttl`
+    uma página expira depois desse número de segundos.
+    """
+    def __init__(
+        self,
+        max_pages: int = HISTORY_PAGE_CACHE_MAX,
+        max_bytes: int = HISTORY_PAGE_CACHE_BYTES,
+        ttl: Optional[float] = PAGE_TTL,
+    ):
+        self.max_pages = max(0, max_pages)
+        self.max_bytes = max(0, max_bytes)
+        self.ttl = ttl
+        self.size = 0
+        # (corpo, ETag, expira em (monotonic) ou None)
+        self._pages: "OrderedDict[PageKey, Tuple[bytes, str, Optional[float]]]" = OrderedDict()
+
+    def get(self, key: PageKey) -> Optional[Tuple[bytes, str]]:
+        page = self._pages.get(key)
+        if page is None:
+            return None
+        body, etag, expires = page
+        if expires is not None and expires < time.monotonic():
+            del self._pages[key]
+            self.size -= len(body)
+            return None
+        self._pages.move_to_end(key)
+        return body, etag
+
+    def put(self, key: PageKey, body: bytes) -> str:
+        """Guarda a página e devolve seu ETag."""
+        etag = page_etag(body)
+        if self.max_pages == 0 or len(body) > self.max_bytes:
+            return etag
+        old = self._pages.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0])
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._pages[key] = (body, etag, expires)
+        self.size += len(body)
+        while len(self._pages) > self.max_pages or self.size > self.max_bytes:
+            _, (evicted, _, _) = self._pages.popitem(last=False)
+            self.size -= len(evicted)
+        return etag
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+
+history_pages = HistoryPageCache()
@@ -0,0 +1,115 @@
+# app/persistence.py
+from typing import List, Optional
+import asyncio
+import logging
+
+from pymongo.errors import PyMongoError
+
+from .config import (
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    WRITE_BEHIND_MAX_BACKLOG,
+    WRITE_BEHIND_MAX_RETRIES,
+    WRITE_BEHIND_RETRY_MAX_DELAY,
+)
+from .store import write_messages
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Persistência write-behind: documentos entram numa fila limitada e uma
+    task grava em lotes via store.write_messages (insert_many ou buckets).
+
+    O lote sai quando atinge `batch_size` ou depois de `flush_interval`
+    segundos. Com a fila cheia, enqueue espera (backpressure). As
+    mensagens já foram publicadas e confirmadas, então um lote que falha é
+    repetido com backoff até gravar (Mongo fora do ar segura os envios em
+    vez de perdê-los); `max_retries` > 0 torna o descarte opcional.
+    """
+    def __init__(
+        self,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+        max_backlog: int = WRITE_BEHIND_MAX_BACKLOG,
+        max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+        retry_max_delay: float = WRITE_BEHIND_RETRY_MAX_DELAY,
+    ):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_max_delay = retry_max_delay
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_backlog)
+        self._full = asyncio.Event()
+        self._inflight: List[dict] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def backlog(self) -> int:
+        """Documentos aguardando gravação."""
+        return self._queue.qsize() + len(self._inflight)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, doc: dict):
+        """Agenda a gravação; espera se o backlog estiver cheio."""
+        await self._queue.put(doc)
+        if self._queue.qsize() >= self.batch_size:
+            self._full.set()
+
+    async def stop(self):
+        """Para a task e grava tudo o que ainda estiver pendente."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        pending = self._inflight + self._drain(self._queue.qsize())
+        self._inflight = []
+        for i in range(0, len(pending), self.batch_size):
+            await self._write(pending[i:i + self.batch_size])
+
+    # ---------------------------
+    # Internos
+    # ---------------------------
+    def _drain(self, limit: int) -> List[dict]:
+        docs = []
+        while len(docs) < limit and not self._queue.empty():
+            docs.append(self._queue.get_nowait())
+        return docs
+
+    async def _run(self):
+        while True:
+            # _inflight guarda o lote atual para o stop() não perdê-lo
+            self._inflight = [await self._queue.get()]
+            if self._queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            self._inflight += self._drain(self.batch_size - 1)
+            await self._write(self._inflight)
+            self._inflight = []
+
+    async def _write(self, docs: List[dict]):
+        """Grava o lote com retry; só os documentos que falharam são repetidos."""
+        attempt = 0
+        while True:
+            try:
+                docs = await write_messages(docs)
+                if not docs:
+                    return
+                logger.warning("Falha ao gravar %d mensagens (tentativa %d)", len(docs), attempt + 1)
+            except PyMongoError:
+                logger.warning("Erro no MongoDB ao gravar lote (tentativa %d)", attempt + 1, exc_info=True)
+            if self.max_retries and attempt >= self.max_retries:
+                logger.error("Descartando %d mensagens após %d tentativas", len(docs), attempt + 1)
+                return
+            await asyncio.sleep(min(0.1 * 2 ** min(attempt, 16), self.retry_max_delay))
+            attempt += 1
+
+
+message_writer = MessageWriter()
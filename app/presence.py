@@ -0,0 +1,168 @@
+# app/presence.py
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import logging
+import time
+import uuid
+
+from .config import PRESENCE_FLUSH_INTERVAL, PRESENCE_SWEEP_INTERVAL, PRESENCE_WINDOW
+from .redis_client import PRESENCE_ROOMS_KEY, get_redis, presence_key
+
+logger = logging.getLogger(__name__)
+
+# Lock de liderança da limpeza: só um nó do cluster varre a presença
+SWEEPER_LEADER_KEY = "presence:sweeper"
+NODE_ID = uuid.uuid4().hex
+SWEEP_CHUNK = 500
+
+# Renova o lock se já é nosso, senão tenta pegá-lo (SET NX).
+# KEYS: lock; ARGV: id do nó, TTL (ms)
+ACQUIRE_LEADER_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+RELEASE_LEADER_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_acquire_script = None
+_release_script = None
+
+
+class PresenceBuffer:
+    """
+    Presença acumulada no nó e gravada em lote a cada `flush_interval`:
+    um ZADD com vários membros por sala e um ZADD no registro, tudo num
+    único pipeline. Além dos toques explícitos (mensagens, heartbeats),
+    `live_users` informa os usuários dos sockets abertos neste nó, que
+    ficam online enquanto o socket viver.
+    """
+    def __init__(
+        self,
+        flush_interval: float = PRESENCE_FLUSH_INTERVAL,
+        live_users: Optional[Callable[[], Iterable[Tuple[str, str]]]] = None,
+    ):
+        self.flush_interval = flush_interval
+        self.live_users = live_users
+        self._pending: Dict[str, Dict[str, int]] = {}
+
+    def touch(self, room: str, username: str):
+        """Marca o usuário como online na sala (gravado no próximo flush)."""
+        self._pending.setdefault(room, {})[username] = int(time.time())
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if self.live_users is not None:
+            now = int(time.time())
+            for room, username in self.live_users():
+                pending.setdefault(room, {})[username] = now
+        if not pending:
+            return
+
+        pipe = get_redis().pipeline(transaction=False)
+        for room, members in pending.items():
+            pipe.zadd(presence_key(room), members)
+        pipe.zadd(PRESENCE_ROOMS_KEY, {room: max(m.values()) for room, m in pending.items()})
+        try:
+            await pipe.execute()
+        except Exception:
+            # devolve ao buffer o que não foi gravado (sem sobrescrever toques novos)
+            for room, members in pending.items():
+                merged = self._pending.setdefault(room, {})
+                for username, ts in members.items():
+                    merged.setdefault(username, ts)
+            raise
+
+    async def run(self):
+        """Loop de flush; grava o que restar ao ser cancelado."""
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.warning("Falha ao gravar presença", exc_info=True)
+        finally:
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+
+presence_buffer = PresenceBuffer()
+
+
+async def online_users(room: str) -> List[str]:
+    """
+    Usuários vistos nos últimos PRESENCE_WINDOW segundos.
+    Remove os expirados no mesmo round trip (limpeza preguiçosa).
+    """
+    now = int(time.time())
+    minscore = now - PRESENCE_WINDOW
+    key = presence_key(room)
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.zremrangebyscore(key, 0, minscore - 1)
+    pipe.zrangebyscore(key, minscore, now)
+    _, members = await pipe.execute()
+    return members
+
+
+async def sweep():
+    """
+    Limpa a presença das salas do registro, sem KEYS nem SCAN: remove os
+    membros expirados (ZSET vazio some sozinho) em pipelines e depois tira
+    do registro as salas sem atividade na janela.
+    """
+    r = get_redis()
+    minscore = int(time.time()) - PRESENCE_WINDOW
+
+    rooms = await r.zrange(PRESENCE_ROOMS_KEY, 0, -1)
+    for i in range(0, len(rooms), SWEEP_CHUNK):
+        pipe = r.pipeline(transaction=False)
+        for room in rooms[i:i + SWEEP_CHUNK]:
+            pipe.zremrangebyscore(presence_key(room), 0, minscore - 1)
+        await pipe.execute()
+    # uma sala tocada durante a varredura tem score novo e fica no registro
+    await r.zremrangebyscore(PRESENCE_ROOMS_KEY, "-inf", minscore - 1)
+
+
+async def is_sweeper_leader(ttl: float) -> bool:
+    """Tenta obter/renovar a liderança da limpeza por `ttl` segundos."""
+    global _acquire_script
+    if _acquire_script is None:
+        _acquire_script = get_redis().register_script(ACQUIRE_LEADER_LUA)
+    res = await _acquire_script(keys=[SWEEPER_LEADER_KEY], args=[NODE_ID, int(ttl * 1000)])
+    return bool(res)
+
+
+async def release_sweeper_leader():
+    global _release_script
+    if _release_script is None:
+        _release_script = get_redis().register_script(RELEASE_LEADER_LUA)
+    await _release_script(keys=[SWEEPER_LEADER_KEY], args=[NODE_ID])
+
+
+async def presence_sweeper(interval: float = PRESENCE_SWEEP_INTERVAL):
+    """Loop de limpeza; só o nó líder varre, os demais apenas disputam o lock."""
+    try:
+        while True:
+            try:
+                if await is_sweeper_leader(ttl=interval * 3):
+                    await sweep()
+            except Exception:
+                logger.warning("Falha na limpeza de presença", exc_info=True)
+            await asyncio.sleep(interval)
+    finally:
+        try:
+            await release_sweeper_leader()
+        except Exception:
+            pass
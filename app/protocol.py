@@ -0,0 +1,145 @@
+# app/protocol.py
+"""
+Protocolo compacto (v2), pedido pelo cliente com ?v=2.
+
+Itens viram {"i": id, "u": uid, "c": conteúdo, "ts": epoch ms}: sem a sala
+(implícita na conexão) e sem nome/avatar, trocados por um id curto da
+tabela de usuários do nó. Cada conexão recebe a definição de um usuário
+({"t":"u"}) uma única vez, antes do primeiro frame que o referencia.
+
+Os ids são globais no nó, então um frame v2 continua sendo serializado uma
+vez e compartilhado por todas as conexões; só os frames de definição são
+por conexão. Cada frame leva as definições dos usuários que referencia,
+então um frame guardado (ring de histórico) continua definível mesmo
+depois que o usuário sai do LRU da tabela. Frames de dados: "m" (mensagem, "s" = id do stream),
+"h" (histórico: "m" itens, "l" last_id, "d" delta), "b" (lote, "f"
+frames) e "a" (confirmação de envio: "c" client_msg_id, "i" id). Frames
+de controle (error, resync) seguem o formato v1.
+"""
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+from .codec import dumps, loads
+from .config import PROTOCOL_USER_TABLE_MAX
+
+PROTOCOL_VERSIONS = (1, 2)
+
+
+class UserTable:
+    """(username, avatar) → id curto, com LRU; ids nunca são reaproveitados."""
+    def __init__(self, max_size: int = PROTOCOL_USER_TABLE_MAX):
+        self.max_size = max(1, max_size)
+        self._ids: "OrderedDict[Tuple[str, Optional[str]], int]" = OrderedDict()
+        self._users: Dict[int, Tuple[str, Optional[str]]] = {}
+        self._next = 1
+
+    def intern(self, username: str, avatar: Optional[str]) -> int:
+        key = (username, avatar)
+        uid = self._ids.get(key)
+        if uid is not None:
+            self._ids.move_to_end(key)
+            return uid
+        uid = self._next
+        self._next += 1
+        self._ids[key] = uid
+        self._users[uid] = key
+        if len(self._ids) > self.max_size:
+            _, old = self._ids.popitem(last=False)
+            self._users.pop(old, None)
+        return uid
+
+    def get(self, uid: int) -> Optional[Tuple[str, Optional[str]]]:
+        return self._users.get(uid)
+
+
+user_table = UserTable()
+
+
+# (nome, avatar) de um uid
+User = Tuple[str, Optional[str]]
+
+
+class CompactFrame(str):
+    """
+    Frame v2 já serializado; `uids` são os usuários que ele referencia e
+    `users` suas definições no momento em que o frame foi montado.
+    """
+    uids: FrozenSet[int] = frozenset()
+    users: Dict[int, User] = {}
+
+
+class UsersFrame(str):
+    """Definição de usuários de uma conexão; nunca é descartada pela fila."""
+
+
+def _frame(text: str, users: Dict[int, User]) -> CompactFrame:
+    frame = CompactFrame(text)
+    frame.users = users
+    frame.uids = frozenset(users)
+    return frame
+
+
+def _timestamp(created_at) -> Optional[int]:
+    if isinstance(created_at, datetime):
+        dt = created_at
+    else:
+        try:
+            dt = datetime.fromisoformat(str(created_at))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def compact_item(item: Union[dict, str]) -> Tuple[dict, int, User]:
+    """Item v1 (dict ou JSON) → item v2, o uid do autor e sua definição."""
+    if isinstance(item, (str, bytes, bytearray)):
+        item = loads(item)
+    user = (item.get("username", ""), item.get("avatar"))
+    uid = user_table.intern(*user)
+    compact = {"i": item.get("id"), "u": uid, "c": item.get("content", ""), "ts": _timestamp(item.get("created_at"))}
+    return compact, uid, user
+
+
+def compact_message_frame(item: Union[dict, str], stream_id: Optional[str] = None) -> CompactFrame:
+    compact, uid, user = compact_item(item)
+    payload: dict = {"t": "m", "m": compact}
+    if stream_id:
+        payload["s"] = stream_id
+    return _frame(dumps(payload), {uid: user})
+
+
+def compact_history_frame(
+    items: Iterable[Union[dict, str]],
+    last_id: Optional[str] = None,
+    delta: bool = False,
+) -> CompactFrame:
+    """Mesma assinatura de ws_manager.history_frame, no formato v2."""
+    compact: List[dict] = []
+    users: Dict[int, User] = {}
+    for item in items:
+        c, uid, user = compact_item(item)
+        compact.append(c)
+        users[uid] = user
+    payload: dict = {"t": "h"}
+    if last_id:
+        payload["l"] = last_id
+    if delta:
+        payload["d"] = 1
+    payload["m"] = compact
+    return _frame(dumps(payload), users)
+
+
+def compact_ack_frame(client_msg_id: str, msg_id: Optional[str]) -> str:
+    return dumps({"t": "a", "c": client_msg_id, "i": msg_id})
+
+
+def compact_batch_frame(frames: Iterable[str]) -> str:
+    return '{"t":"b","f":[' + ",".join(frames) + "]}"
+
+
+def users_frame(users: Dict[int, User]) -> UsersFrame:
+    """{"t":"u","u":[[uid, nome, avatar], ...]} para as definições informadas."""
+    rows = [[uid, users[uid][0], users[uid][1]] for uid in sorted(users)]
+    return UsersFrame(dumps({"t": "u", "u": rows}))
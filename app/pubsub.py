@@ -0,0 +1,219 @@
+# app/pubsub.py
+from typing import Awaitable, Callable, Dict, Optional, Set
+import asyncio
+import logging
+
+from redis.asyncio.client import PubSub
+from redis.exceptions import RedisError
+
+from .config import PUBSUB_UNSUBSCRIBE_DELAY, REDIS_CLUSTER, REDIS_SHARDED_PUBSUB
+from .redis_client import channel_room, get_pubsub_redis, room_channel
+
+logger = logging.getLogger(__name__)
+
+# handler(room, data, stream_id): data é o item em JSON, sem decodificar;
+# stream_id só existe no backend de Redis Streams
+MessageHandler = Callable[[str, str, Optional[str]], Awaitable[None]]
+
+
+class RoomFeed:
+    """
+    Base das fontes de mensagens por sala (Pub/Sub ou Streams): o nó só
+    recebe mensagens das salas que têm sockets locais.
+
+    Cada socket faz acquire ao entrar e release ao sair (contagem de
+    referências). Quando a contagem chega a zero a sala só é desativada
+    depois de `unsubscribe_delay` segundos, e isso é cancelado se alguém
+    voltar. Subclasses implementam _activate/_deactivate/listen.
+    `on_deactivate(room)` é chamado quando a sala deixa de ser recebida e
+    `on_reset()` quando mensagens de qualquer sala podem ter sido perdidas
+    (queda da conexão).
+    """
+    def __init__(self, unsubscribe_delay: float = PUBSUB_UNSUBSCRIBE_DELAY):
+        self.unsubscribe_delay = unsubscribe_delay
+        self._refs: Dict[str, int] = {}
+        # salas efetivamente ativas (alterado só sob _lock)
+        self._subscribed: Set[str] = set()
+        self._pending: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+        self.on_deactivate: Optional[Callable[[str], None]] = None
+        self.on_reset: Optional[Callable[[], None]] = None
+
+    @property
+    def rooms(self) -> Set[str]:
+        """Salas ativas neste nó."""
+        return set(self._subscribed)
+
+    async def acquire(self, room: str):
+        """Registra um socket local na sala, ativando-a se preciso."""
+        self._refs[room] = self._refs.get(room, 0) + 1
+        handle = self._pending.pop(room, None)
+        if handle:
+            handle.cancel()
+        try:
+            async with self._lock:
+                if room not in self._subscribed:
+                    await self._activate(room)
+                    self._subscribed.add(room)
+        except Exception:
+            self.release(room)
+            raise
+        self._ready.set()
+
+    def release(self, room: str):
+        """Remove um socket local da sala; agenda a desativação no último."""
+        refs = self._refs.get(room, 0) - 1
+        if refs > 0:
+            self._refs[room] = refs
+            return
+        self._refs.pop(room, None)
+        if room not in self._pending:
+            loop = asyncio.get_running_loop()
+            self._pending[room] = loop.call_later(self.unsubscribe_delay, self._expire, room)
+
+    def _expire(self, room: str):
+        self._pending.pop(room, None)
+        if self._refs.get(room):
+            return
+        task = asyncio.ensure_future(self._unsubscribe(room))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _unsubscribe(self, room: str):
+        async with self._lock:
+            # a sala pode ter voltado a ter sockets enquanto esperava o lock
+            if self._refs.get(room) or room not in self._subscribed:
+                return
+            try:
+                await self._deactivate(room)
+            except Exception:
+                logger.exception("Falha ao desativar a sala %s", room)
+                return
+            self._subscribed.discard(room)
+            if self.on_deactivate is not None:
+                self.on_deactivate(room)
+
+    def _reset(self):
+        if self.on_reset is not None:
+            self.on_reset()
+
+    def _cancel_pending(self):
+        for handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+
+    async def _activate(self, room: str):
+        raise NotImplementedError
+
+    async def _deactivate(self, room: str):
+        raise NotImplementedError
+
+    async def listen(self, handler: MessageHandler):
+        raise NotImplementedError
+
+    async def close(self):
+        self._cancel_pending()
+        self._subscribed.clear()
+
+
+class RoomSubscriptions(RoomFeed):
+    """
+    Inscrição Pub/Sub dinâmica em chat:{room} para as salas com sockets locais.
+
+    Com `sharded` usa SSUBSCRIBE: no Redis Cluster cada canal é atendido
+    pelo nó dono do seu slot, em vez de toda publicação passar por todos
+    os nós.
+    """
+    def __init__(
+        self,
+        unsubscribe_delay: float = PUBSUB_UNSUBSCRIBE_DELAY,
+        sharded: bool = REDIS_SHARDED_PUBSUB,
+    ):
+        super().__init__(unsubscribe_delay)
+        self.sharded = sharded
+        self._pubsub: Optional[PubSub] = None
+        self._watched = None
+
+    def _get_pubsub(self) -> PubSub:
+        if self._pubsub is None:
+            self._pubsub = get_pubsub_redis().pubsub()
+        return self._pubsub
+
+    async def _activate(self, room: str):
+        pubsub = self._get_pubsub()
+        if self.sharded:
+            await pubsub.ssubscribe(room_channel(room))
+        else:
+            await pubsub.subscribe(room_channel(room))
+        # o redis-py reconecta e refaz as inscrições sozinho, sem erro
+        # visível no listen: o callback avisa que houve uma lacuna
+        connection = getattr(pubsub, "connection", None)
+        if connection is not None and connection is not self._watched:
+            connection.register_connect_callback(self._on_reconnect)
+            self._watched = connection
+
+    def _on_reconnect(self, connection):
+        logger.warning("Conexão Pub/Sub refeita; mensagens podem ter sido perdidas")
+        self._reset()
+
+    async def _deactivate(self, room: str):
+        if self.sharded:
+            await self._get_pubsub().sunsubscribe(room_channel(room))
+        else:
+            await self._get_pubsub().unsubscribe(room_channel(room))
+
+    async def _read(self, pubsub: PubSub) -> Optional[dict]:
+        if self.sharded and REDIS_CLUSTER:
+            # uma conexão por nó dono de canais; lê de todas
+            return await pubsub.get_sharded_message(ignore_subscribe_messages=True, timeout=1.0)
+        return await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+
+    async def listen(self, handler: MessageHandler):
+        """
+        Lê mensagens das salas inscritas e chama handler(room, data, None)
+        com o payload cru (sem decodificar o JSON).
+        """
+        # a conexão Pub/Sub só existe depois do primeiro subscribe
+        await self._ready.wait()
+        pubsub = self._get_pubsub()
+        while True:
+            try:
+                message = await self._read(pubsub)
+            except (ConnectionError, RedisError):
+                # a conexão é refeita (com re-subscribe) na próxima leitura
+                logger.warning("Conexão Pub/Sub perdida, tentando novamente")
+                self._reset()
+                await asyncio.sleep(1)
+                continue
+            if not message or message.get("type") not in ("message", "smessage"):
+                continue
+
+            channel = message.get("channel")
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            room = channel_room(channel)
+            if room is None:
+                continue
+
+            data = message.get("data")
+            if not data:
+                continue
+            await handler(room, data, None)
+
+    async def close(self):
+        """Cancela unsubscribes pendentes e fecha a conexão Pub/Sub."""
+        self._cancel_pending()
+        if self._pubsub is not None:
+            try:
+                if self.sharded:
+                    await self._pubsub.sunsubscribe()
+                else:
+                    await self._pubsub.unsubscribe()
+                await self._pubsub.close()
+            except Exception:
+                pass
+            self._pubsub = None
+            self._watched = None
+        self._subscribed.clear()
@@ -1,46 +1,285 @@
 # redis_client.py
-import os
 import redis.asyncio as redis
-from typing import Any
-import json
+from redis.asyncio.cluster import RedisCluster
+from typing import Any, Dict, Optional, Tuple, Union
 
-# Configurações via ENV, com defaults para Docker Compose
-REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
-REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+from .config import (
+    REDIS_CLUSTER,
+    REDIS_CONNECT_TIMEOUT,
+    REDIS_DB,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_HOST,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT,
+    REDIS_PORT,
+    REDIS_PUBSUB_MAX_CONNECTIONS,
+    REDIS_SHARDED_PUBSUB,
+    REDIS_SOCKET_TIMEOUT,
+)
 
-_redis: redis.Redis | None = None
+RedisClient = Union[redis.Redis, RedisCluster]
 
-def get_redis() -> redis.Redis:
+# ---------------------------
+# Clientes
+# ---------------------------
+# Dois clientes com pools separados: comandos curtos (rate limit, ingestão,
+# presença, histórico) e conexões de longa duração (Pub/Sub, XREAD BLOCK),
+# para que uma não esgote nem bloqueie as conexões da outra.
+_redis: Optional[RedisClient] = None
+_pubsub_redis: Optional[RedisClient] = None
+
+def _client(max_connections: int, socket_timeout: Optional[float]) -> RedisClient:
+    if REDIS_CLUSTER:
+        # no Cluster o limite de conexões vale por nó
+        return RedisCluster(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            decode_responses=True,
+            max_connections=max_connections,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        )
+    pool = redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        decode_responses=True,
+        max_connections=max_connections,
+        # espera por uma conexão livre em vez de falhar com o pool cheio
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    return redis.Redis(connection_pool=pool)
+
+def get_redis() -> RedisClient:
     """
-    Retorna o cliente Redis singleton para evitar múltiplas conexões.
+    Cliente Redis singleton dos comandos (pool limitado e com timeouts).
     """
     global _redis
     if _redis is None:
-        _redis = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            db=REDIS_DB,
-            decode_responses=True
-        )
+        _redis = _client(REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT)
     return _redis
 
-async def publish_message(channel: str, message: Any):
+def get_pubsub_redis() -> RedisClient:
     """
-    Publica uma mensagem em Pub/Sub Redis para a sala.
+    Cliente singleton para Pub/Sub e leituras bloqueantes: cada assinatura
+    segura uma conexão própria, sem socket timeout (o health check detecta
+    conexões mortas).
     """
-    r = get_redis()
-    if not isinstance(message, str):
-        message = json.dumps(message, default=str)
-    await r.publish(f"chat:{channel}", message)
+    global _pubsub_redis
+    if _pubsub_redis is None:
+        _pubsub_redis = _client(REDIS_PUBSUB_MAX_CONNECTIONS, None)
+    return _pubsub_redis
+
+async def close_redis():
+    """Fecha os dois clientes (shutdown)."""
+    global _redis, _pubsub_redis
+    for client in (_redis, _pubsub_redis):
+        if client is not None:
+            try:
+                await client.aclose()
+            except Exception:
+                pass
+    _redis = _pubsub_redis = None
+
+# ---------------------------
+# Chaves e canais
+# ---------------------------
+# Todas as chaves de uma sala levam a sala como hash tag ({sala}): no
+# Redis Cluster ficam no mesmo slot, e os scripts de ingestão (rate limit,
+# recentes/stream, idempotência e o canal) rodam num único nó.
+def room_tag(room: str) -> str:
+    """Hash tag da sala."""
+    return "{" + room + "}"
+
+CHANNEL_PREFIX = "chat:{"
+CHANNEL_SUFFIX = "}"
+
+def room_channel(room: str) -> str:
+    """Canal Pub/Sub da sala."""
+    return f"{CHANNEL_PREFIX}{room}{CHANNEL_SUFFIX}"
+
+def channel_room(channel: str) -> Optional[str]:
+    """Sala de um canal de room_channel, ou None se o canal não é de sala."""
+    if not (channel.startswith(CHANNEL_PREFIX) and channel.endswith(CHANNEL_SUFFIX)):
+        return None
+    return channel[len(CHANNEL_PREFIX):-len(CHANNEL_SUFFIX)]
+
+# Comando de publicação nas salas (Pub/Sub clássico ou shardeado)
+PUBLISH_COMMAND = "SPUBLISH" if REDIS_SHARDED_PUBSUB else "PUBLISH"
+
+def recent_key(room: str) -> str:
+    """LIST com as mensagens recentes da sala."""
+    return f"chat:{room_tag(room)}:recent"
+
+def presence_key(room: str) -> str:
+    """ZSET de presença da sala (membro → último timestamp visto)."""
+    return f"chat:{room_tag(room)}:presence"
+
+# ZSET com as salas que tiveram presença (sala → último timestamp)
+PRESENCE_ROOMS_KEY = "presence:rooms"
+
+def stream_key(room: str) -> str:
+    """Redis Stream da sala (backend ROOM_LOG_BACKEND=stream)."""
+    return f"chat:{room_tag(room)}:stream"
+
+def rate_limit_key(room: str, username: str, route: str) -> str:
+    """Estado do rate limit do usuário na sala, por rota (ws/rest)."""
+    return f"rl:{room_tag(room)}:{username}:{route}"
+
+def idempotency_key(room: str, username: str, client_msg_id: str) -> str:
+    """Item aceito para um client_msg_id (deduplica reenvios do cliente)."""
+    return f"idem:{room_tag(room)}:{username}:{client_msg_id}"
+
+# ---------------------------
+# Rate limit (função Lua compartilhada)
+# ---------------------------
+# rate_limit(chave, algoritmo, limite, janela_ms, membro) → true/false.
+# Usa o relógio do Redis (TIME), igual para todos os nós, e sempre renova
+# o TTL no mesmo passo atômico: nenhuma chave fica sem expiração.
+# - sliding_window: ZSET com o instante de cada envio aceito na janela
+# - token_bucket: HASH com tokens restantes, reabastecidos a limite/janela
+RATE_LIMIT_LUA_FN = """
+local function rate_limit(key, algorithm, limit, window_ms, member)
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    if algorithm == 'token_bucket' then
+        local state = redis.call('HMGET', key, 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or limit
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(limit, tokens + (now - ts) * limit / window_ms)
+        local allowed = tokens >= 1
+        if allowed then
+            tokens = tokens - 1
+        end
+        redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('PEXPIRE', key, window_ms)
+        return allowed
+    end
+    redis.call('ZREMRANGEBYSCORE', key, 0, now - window_ms)
+    if redis.call('ZCARD', key) >= limit then
+        return false
+    end
+    redis.call('ZADD', key, now, member)
+    redis.call('PEXPIRE', key, window_ms)
+    return true
+end
+"""
+
+def _rate_limit_args(policy: Tuple[str, int, float], member: str) -> list:
+    """ARGV do rate limit a partir de (algoritmo, limite, janela em segundos)."""
+    algorithm, limit, window = policy
+    return [algorithm, limit, int(window * 1000), member]
+
+_scripts: Dict[str, Any] = {}
+
+def _script(lua: str):
+    """Script registrado (EVALSHA com fallback para EVAL)."""
+    script = _scripts.get(lua)
+    if script is None:
+        script = _scripts[lua] = get_redis().register_script(lua)
+    return script
+
+# ---------------------------
+# Ingestão de mensagens (1 round trip)
+# ---------------------------
+# Rate limit, cache de recentes e Pub/Sub (PUBLISH_COMMAND) num único
+# script, executado atomicamente. A presença vai pelo PresenceBuffer (app/presence.py).
+# Com client_msg_id, KEYS[3] guarda o item aceito por ARGV[8] ms: um
+# reenvio devolve {2, item} sem consumir rate limit nem publicar de novo.
+# KEYS: rate limit, recentes[, idempotência]
+# ARGV: algoritmo, limite, janela (ms), membro, item JSON, tamanho da lista, canal, TTL (ms)
+# Retorno: {1} aceito, {0} limitado, {2, item original} repetido
+INGEST_LUA = RATE_LIMIT_LUA_FN + """
+if #KEYS >= 3 then
+    local prev = redis.call('GET', KEYS[3])
+    if prev then
+        return {2, prev}
+    end
+end
+if not rate_limit(KEYS[1], ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), ARGV[4]) then
+    return {0}
+end
+redis.call('LPUSH', KEYS[2], ARGV[5])
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[6]) - 1)
+redis.call('""" + PUBLISH_COMMAND + """', ARGV[7], ARGV[5])
+if #KEYS >= 3 then
+    redis.call('SET', KEYS[3], ARGV[5], 'PX', ARGV[8])
+end
+return {1}
+"""
+
+# Resultado da ingestão: status (INGEST_*), item original se repetido,
+# id da entrada no stream se aceito no backend de Streams
+INGEST_LIMITED, INGEST_ACCEPTED, INGEST_DUPLICATE = 0, 1, 2
+
+def _ingest_keys(keys: list, idem_key: Optional[str]) -> list:
+    return keys + [idem_key] if idem_key else keys
+
+async def ingest_recent(
+    room: str,
+    rate_key: str,
+    policy: Tuple[str, int, float],
+    member: str,
+    item: str,
+    maxlen: int = 50,
+    idem_key: Optional[str] = None,
+    idem_ttl: float = 0,
+) -> Tuple[int, Optional[str]]:
+    """
+    Aplica o rate limit (`policy` = algoritmo, limite, janela) e, se
+    permitido, grava a mensagem nos recentes e publica na sala.
+    Retorna (status, item original): INGEST_LIMITED se o usuário excedeu o
+    limite, INGEST_DUPLICATE (com o item já aceito) se `idem_key` já existe.
+    """
+    res = await _script(INGEST_LUA)(
+        keys=_ingest_keys([rate_key, recent_key(room)], idem_key),
+        args=_rate_limit_args(policy, member) + [item, maxlen, room_channel(room), int(idem_ttl * 1000)],
+    )
+    return int(res[0]), (res[1] if len(res) > 1 else None)
+
+# Mesmo fluxo do INGEST_LUA, mas com a sala num Redis Stream: um XADD
+# substitui LPUSH/LTRIM/PUBLISH.
+# KEYS: rate limit, stream[, idempotência]
+# ARGV: algoritmo, limite, janela (ms), membro, item JSON, MAXLEN aproximado, TTL (ms)
+# Retorno: {1, id da entrada} aceito, {0} limitado, {2, item original} repetido
+INGEST_STREAM_LUA = RATE_LIMIT_LUA_FN + """
+if #KEYS >= 3 then
+    local prev = redis.call('GET', KEYS[3])
+    if prev then
+        return {2, prev}
+    end
+end
+if not rate_limit(KEYS[1], ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), ARGV[4]) then
+    return {0}
+end
+local id = redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[6], '*', 'm', ARGV[5])
+if #KEYS >= 3 then
+    redis.call('SET', KEYS[3], ARGV[5], 'PX', ARGV[7])
+end
+return {1, id}
+"""
 
-async def push_recent(room: str, value: Any, maxlen: int = 50):
+async def ingest_stream(
+    room: str,
+    rate_key: str,
+    policy: Tuple[str, int, float],
+    member: str,
+    item: str,
+    maxlen: int,
+    idem_key: Optional[str] = None,
+    idem_ttl: float = 0,
+) -> Tuple[int, Optional[str]]:
     """
-    Armazena a última mensagem no Redis LIST de mensagens recentes da sala.
+    Como ingest_recent, para o backend de Streams. Se aceito, o segundo
+    valor é o id da entrada no stream; se repetido, o item original.
     """
-    r = get_redis()
-    if not isinstance(value, str):
-        value = json.dumps(value, default=str)
-    key = f"chat:{room}:recent"
-    await r.lpush(key, value)
-    await r.ltrim(key, 0, maxlen - 1)
+    res = await _script(INGEST_STREAM_LUA)(
+        keys=_ingest_keys([rate_key, stream_key(room)], idem_key),
+        args=_rate_limit_args(policy, member) + [item, maxlen, int(idem_ttl * 1000)],
+    )
+    return int(res[0]), (res[1] if len(res) > 1 else None)
@@ -0,0 +1,129 @@
+# app/room_cache.py
+from collections import OrderedDict
+from typing import Optional, Tuple
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from .codec import dumpb
+from .config import ROOM_CACHE_MAX, ROOM_CACHE_TTL
+from .database import get_db
+from .redis_client import get_pubsub_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Canal Pub/Sub em que create_room avisa os outros nós
+ROOMS_INVALIDATE_CHANNEL = "rooms:invalidate"
+# Payload que invalida o cache inteiro
+ALL_ROOMS = "*"
+
+
+def _hash_password(password: Optional[str]) -> Optional[str]:
+    if password is None:
+        return None
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+class RoomCache:
+    """
+    Cache em memória dos metadados das salas (nome, is_private, hash da
+    senha) com TTL e despejo LRU, mais a listagem de salas já serializada
+    com ETag. Salas inexistentes também ficam em cache (como None).
+    """
+    def __init__(self, ttl: float = ROOM_CACHE_TTL, max_size: int = ROOM_CACHE_MAX):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self._listing: Optional[Tuple[float, bytes, str]] = None
+
+    async def get(self, name: str) -> Optional[dict]:
+        """Metadados da sala, ou None se ela não existe."""
+        entry = self._entries.get(name)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(name)
+            return entry[1]
+
+        doc = await get_db()["rooms"].find_one({"name": name})
+        meta = None
+        if doc:
+            meta = {
+                "name": doc["name"],
+                "is_private": bool(doc.get("is_private")),
+                "password_hash": _hash_password(doc.get("password")),
+            }
+        self._entries[name] = (time.monotonic() + self.ttl, meta)
+        self._entries.move_to_end(name)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return meta
+
+    async def listing(self) -> Tuple[bytes, str]:
+        """Corpo JSON de {"rooms": [...]} (sem senhas) e seu ETag."""
+        if self._listing and self._listing[0] > time.monotonic():
+            return self._listing[1], self._listing[2]
+
+        cursor = get_db()["rooms"].find({}, {"password": 0})
+        rooms = []
+        async for r in cursor:
+            r["id"] = str(r.pop("_id"))
+            rooms.append(r)
+        body = dumpb({"rooms": rooms})
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self._listing = (time.monotonic() + self.ttl, body, etag)
+        return body, etag
+
+    def invalidate(self, name: str = ALL_ROOMS):
+        """Descarta uma sala (ou todas) e a listagem."""
+        if name == ALL_ROOMS:
+            self._entries.clear()
+        else:
+            self._entries.pop(name, None)
+        self._listing = None
+
+
+def verify_password(meta: dict, password: Optional[str]) -> bool:
+    """Confere a senha de uma sala privada contra o hash em cache."""
+    expected = meta.get("password_hash")
+    given = _hash_password(password)
+    if expected is None or given is None:
+        return expected == given
+    return hmac.compare_digest(expected, given)
+
+
+room_cache = RoomCache()
+
+
+async def publish_room_invalidation(name: str):
+    """Invalida a sala neste nó e avisa os demais."""
+    room_cache.invalidate(name)
+    await get_redis().publish(ROOMS_INVALIDATE_CHANNEL, name)
+
+
+async def room_cache_listener():
+    """
+    Aplica as invalidações publicadas pelos outros nós.
+    Se a conexão cair, eventos podem ter sido perdidos: limpa tudo.
+    """
+    pubsub = get_pubsub_redis().pubsub()
+    try:
+        await pubsub.subscribe(ROOMS_INVALIDATE_CHANNEL)
+        while True:
+            try:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except (ConnectionError, RedisError):
+                logger.warning("Conexão de invalidação de salas perdida")
+                room_cache.invalidate()
+                await asyncio.sleep(1)
+                continue
+            if message and message.get("type") == "message":
+                room_cache.invalidate(message.get("data") or ALL_ROOMS)
+    finally:
+        try:
+            await pubsub.unsubscribe()
+            await pubsub.close()
+        except Exception:
+            pass
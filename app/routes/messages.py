@@ -1,94 +1,149 @@
 # app/routes/messages.py
-from fastapi import APIRouter, HTTPException, Query, status
-from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from datetime import datetime
 from bson import ObjectId
 from typing import Optional
 
-from ..database import get_db
+from ..admission import shed_load
+from ..codec import dumpb, message_item
+from ..export import as_utc, export_chunks, export_lines
+from ..ingest import ingest_message
+from ..metrics import HISTORY_PAGES_CACHED, HISTORY_PAGES_QUERIED
 from ..models import MessageIn
-from ..redis_client import push_recent, publish_message
-from ..utils.rate_limit import check_rate_limit, RATE_LIMIT_WINDOW, RATE_LIMIT_MAX
+from ..page_cache import (
+    IMMUTABLE_CACHE_CONTROL,
+    REVALIDATE_CACHE_CONTROL,
+    etag_matches,
+    history_pages,
+    is_immutable,
+    page_etag,
+)
+from ..search import decode_cursor, encode_cursor, search_messages
+from ..store import fetch_messages
+from ..utils.rate_limit import get_policy
 
 router = APIRouter(prefix="/rooms", tags=["Messages"])
 
-def serialize_message(doc: dict) -> dict:
-    """Serializa mensagens para envio ao cliente."""
-    return {
-        "id": str(doc.get("_id") or doc.get("id") or ""),
-        "room": doc.get("room", ""),
-        "username": doc.get("username", ""),
-        "content": doc.get("content", ""),
-        "avatar": doc.get("avatar"),
-        "created_at": (
-            doc["created_at"].isoformat() if isinstance(doc.get("created_at"), datetime)
-            else str(doc.get("created_at"))
-        )
-    }
+def parse_object_id(value: Optional[str], name: str) -> Optional[ObjectId]:
+    """Converte o cursor da query em ObjectId (400 se inválido)."""
+    if not value:
+        return None
+    try:
+        return ObjectId(value)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{name} inválido.")
 
-@router.get("/{room}/messages")
+@router.get("/{room}/messages", dependencies=[Depends(shed_load)])
 async def get_messages(
+    request: Request,
     room: str,
     limit: int = Query(50, ge=1, le=200),
-    before_id: Optional[str] = Query(None)
+    before_id: Optional[str] = Query(None),
+    after_id: Optional[str] = Query(None)
+):
+    """
+    Retorna mensagens de uma sala.
+    before_id pagina para trás (next_cursor = mais antiga da página);
+    after_id traz as posteriores (next_cursor = mais nova da página).
+
+    Toda página sai com ETag (304 com If-None-Match). Páginas before_id
+    antigas o bastante são imutáveis: vêm do cache do nó, sem consulta, e
+    podem ser guardadas por navegador/CDN.
+    """
+    before = parse_object_id(before_id, "before_id")
+    after = parse_object_id(after_id, "after_id")
+
+    immutable = after is None and is_immutable(before)
+    key = (room, str(before), limit)
+    page = history_pages.get(key) if immutable else None
+    if page is not None:
+        HISTORY_PAGES_CACHED.inc()
+        body, etag = page
+    else:
+        HISTORY_PAGES_QUERIED.inc()
+        docs = [message_item(d) for d in await fetch_messages(room, limit, before, after)]
+        if after is not None:
+            next_cursor = docs[-1]["id"] if docs else after_id
+        else:
+            next_cursor = docs[0]["id"] if docs else None
+        body = dumpb({"items": docs, "next_cursor": next_cursor})
+        etag = history_pages.put(key, body) if immutable else page_etag(body)
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/{room}/search")
+async def search_room(
+    room: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None)
 ):
     """
-    Retorna mensagens de uma sala (paginação via before_id)
+    Busca textual nas mensagens da sala, ordenada por relevância.
+    next_cursor (score + id da última) traz a próxima página.
     """
-    query = {"room": room}
-    if before_id:
+    after = None
+    if cursor:
         try:
-            query["_id"] = {"$lt": ObjectId(before_id)}
-        except Exception:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="before_id inválido.")
+            after = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="cursor inválido.")
 
-    cursor = get_db()["messages"].find(query).sort("_id", -1).limit(limit)
-    docs = [serialize_message(d) async for d in cursor]
-    docs.reverse()
-    next_cursor = docs[0]["id"] if docs else None
-    return {"items": docs, "next_cursor": next_cursor}
+    docs = await search_messages(room, q.strip(), limit, after)
+    items = [dict(message_item(d), score=d["score"]) for d in docs]
+    next_cursor = encode_cursor(docs[-1]["score"], docs[-1]["_id"]) if len(docs) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
-@router.post("/{room}/messages", status_code=201)
+@router.get("/{room}/messages/export")
+async def export_messages(
+    room: str,
+    after_id: Optional[str] = Query(None),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    gzip: bool = Query(False)
+):
+    """
+    Exporta o histórico da sala em NDJSON (uma mensagem por linha, em
+    ordem de _id), direto do cursor do MongoDB e sem limite de tamanho.
+    since/until filtram por created_at (until exclusivo); uma exportação
+    interrompida é retomada com after_id = id da última linha recebida.
+    """
+    after = parse_object_id(after_id, "after_id")
+    if since and until and as_utc(since) >= as_utc(until):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="since deve ser anterior a until.")
+
+    filename = "messages.ndjson.gz" if gzip else "messages.ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    lines = export_lines(room, after, since, until)
+    return StreamingResponse(
+        export_chunks(lines, gzip=gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers=headers,
+    )
+
+@router.post("/{room}/messages", status_code=201, dependencies=[Depends(shed_load)])
 async def post_message(room: str, payload: MessageIn):
     """
     Recebe mensagem do cliente, salva no MongoDB e publica via Redis.
-    Evita duplicação usando ID único e push/publish sequenciais.
+    Rate limit, cache, Pub/Sub e presença saem em um único round trip.
     """
     content = payload.content.strip()
     if not content:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Mensagem não pode ser vazia.")
 
-    # Rate limit por usuário
-    allowed = await check_rate_limit(room, payload.username)
-    if not allowed:
+    serial_item = await ingest_message(room, payload, "rest")
+    if serial_item is None:
         raise HTTPException(
             status_code=429,
-            detail=f"Rate limit: max {RATE_LIMIT_MAX} msgs / {RATE_LIMIT_WINDOW}s"
+            detail=get_policy("rest", room).describe()
         )
 
-    # Cria documento da mensagem
-    doc = {
-        "room": room,
-        "username": payload.username,
-        "content": content,
-        "avatar": payload.avatar,
-        "created_at": datetime.now(timezone.utc),
-    }
-
-    # Inserção no MongoDB (garante ID único)
-    res = await get_db()["messages"].insert_one(doc)
-    doc["_id"] = res.inserted_id
-
-    # Serializa mensagem
-    serial_item = serialize_message(doc)
-    message_payload = {
-        "type": "message",
-        "item": serial_item
-    }
-
-    # Push para Redis (lista recente) e publicação única no Pub/Sub
-    await push_recent(room, serial_item, maxlen=50)
-    await publish_message(room, message_payload)
-
     # Retorna mensagem para o remetente
     return serial_item
-# -------------------------------
\ No newline at end of file
@@ -1,18 +1,17 @@
 # app/routes/rooms.py
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, Response, status
 from typing import List, Dict
 from datetime import datetime
-import time
+
+from pymongo.errors import DuplicateKeyError
 
 from ..database import get_db
 from ..models import RoomIn, RoomCreate
-from ..redis_client import get_redis
+from ..presence import online_users
+from ..room_cache import publish_room_invalidation, room_cache, verify_password
 
 router = APIRouter(prefix="/rooms", tags=["Rooms"])
 
-# Constante para presença online (segundos)
-PRESENCE_WINDOW = 60
-
 # -------------------------------
 # Redis Presence
 # -------------------------------
@@ -22,30 +21,23 @@ async def get_presence(room: str):
     """
     Lista usuários online nos últimos PRESENCE_WINDOW segundos
     """
-    r = get_redis()
-    now = int(time.time())
-    minscore = now - PRESENCE_WINDOW
-    key = f"chat:{room}:presence"
-    members = await r.zrangebyscore(key, minscore, now)
-    return {"online": members}
+    return {"online": await online_users(room)}
 
 # -------------------------------
 # Salas
 # -------------------------------
 
 @router.get("/")
-async def list_rooms():
+async def list_rooms(request: Request):
     """
-    Lista salas públicas/privadas (sem expor senhas)
+    Lista salas públicas/privadas (sem expor senhas).
+    Resposta pré-serializada do cache local, com ETag.
     """
-    db = get_db()
-    cursor = db["rooms"].find({}, {"password": 0})
-    rooms = [r async for r in cursor]
-
-    for r in rooms:
-        r["id"] = str(r["_id"])
-        r.pop("_id", None)
-    return {"rooms": rooms}
+    body, etag = await room_cache.listing()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @router.post("/", status_code=201)
 async def create_room(payload: RoomIn):
@@ -55,7 +47,7 @@ async def create_room(payload: RoomIn):
     db = get_db()
     name = payload.name
 
-    if await db["rooms"].find_one({"name": name}):
+    if await room_cache.get(name):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Sala já existe.")
 
     doc = {
@@ -65,7 +57,12 @@ async def create_room(payload: RoomIn):
         "created_at": datetime.utcnow(),
     }
 
-    res = await db["rooms"].insert_one(doc)
+    try:
+        res = await db["rooms"].insert_one(doc)
+    except DuplicateKeyError:
+        # criação concorrente: o índice único em rooms.name barra a segunda
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Sala já existe.")
+    await publish_room_invalidation(name)
     return {"id": str(res.inserted_id), "name": name, "is_private": doc["is_private"]}
 
 @router.post("/{room}/join")
@@ -73,14 +70,12 @@ async def join_room(room: str, data: Dict):
     """
     Entra em sala privada ou pública
     """
-    db = get_db()
-    r = await db["rooms"].find_one({"name": room})
-    if not r:
+    meta = await room_cache.get(room)
+    if not meta:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sala não encontrada.")
 
-    if r.get("is_private"):
-        password = data.get("password")
-        if password != r.get("password"):
+    if meta["is_private"]:
+        if not verify_password(meta, data.get("password")):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Senha inválida.")
 
     return {"ok": True, "room": room}
@@ -0,0 +1,80 @@
+# app/search.py
+from typing import List, Optional, Tuple
+import re
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from .config import MESSAGE_STORAGE
+from .database import get_db
+from .store import BUCKETS, MESSAGES
+
+# (score, _id) da última mensagem de uma página
+SearchCursor = Tuple[float, ObjectId]
+
+
+def _terms_pattern(q: str) -> Optional[str]:
+    """Regex com os termos positivos da busca (sem "-termo" e aspas)."""
+    terms = [t.strip('"') for t in q.split() if not t.startswith("-")]
+    terms = [re.escape(t) for t in terms if t]
+    return "|".join(terms) or None
+
+
+def encode_cursor(score: float, oid: ObjectId) -> str:
+    # repr preserva o float exato para a comparação de igualdade
+    return f"{score!r}_{oid}"
+
+
+def decode_cursor(value: str) -> SearchCursor:
+    """"score_id" → (score, ObjectId); ValueError se inválido."""
+    score, _, oid = value.partition("_")
+    try:
+        return float(score), ObjectId(oid)
+    except (InvalidId, TypeError) as e:
+        raise ValueError(str(e))
+
+
+async def search_messages(
+    room: str,
+    q: str,
+    limit: int,
+    after: Optional[SearchCursor] = None,
+) -> List[dict]:
+    """
+    Mensagens da sala que casam com `q`, da mais relevante para a menos
+    (empate: mais nova primeiro), com o score em "score".
+
+    Usa o índice de texto room_content_text: só as mensagens da sala que
+    contêm os termos são lidas, nunca a sala inteira. A paginação é
+    keyset sobre (score, _id).
+
+    Com MESSAGE_STORAGE=buckets o índice encontra os buckets e as
+    mensagens são filtradas pelos termos (sem stemming) e herdam o score
+    do bucket.
+    """
+    pipeline: List[dict] = [
+        {"$match": {"room": room, "$text": {"$search": q}}},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ]
+    collection = MESSAGES
+    if MESSAGE_STORAGE == "buckets":
+        collection = BUCKETS
+        pipeline.append({"$unwind": "$messages"})
+        pattern = _terms_pattern(q)
+        if pattern:
+            pipeline.append({"$match": {"messages.content": {"$regex": pattern, "$options": "i"}}})
+        pipeline.append({"$replaceRoot": {"newRoot": {
+            "$mergeObjects": ["$messages", {"room": "$room", "score": "$score"}],
+        }}})
+    if after is not None:
+        score, oid = after
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "_id": {"$lt": oid}},
+        ]}})
+    pipeline += [
+        {"$sort": {"score": -1, "_id": -1}},
+        {"$limit": limit},
+    ]
+    cursor = get_db()[collection].aggregate(pipeline)
+    return [d async for d in cursor]
@@ -5,6 +5,13 @@
   let room = initialRoom;
   let ws = null;
   let heartbeatInterval = null;
+  let reconnectTimer = null;
+  let reconnectDelay = 1000; // backoff da reconexão (ms), volta a 1s ao conectar
+  let lastId = null; // último id do stream recebido (retomada na reconexão)
+  let lastMsgId = null; // id (ObjectId) da mensagem mais nova na tela
+  let users = new Map(); // protocolo v2: uid → { name, avatar } desta conexão
+  const seenIds = new Set(); // ids das mensagens na tela
+  const outbox = new Map(); // client_msg_id → payload ainda sem ack (reenviado ao reconectar)
   let user = JSON.parse(localStorage.getItem('user')) || null;
 
   const roomsEl = document.getElementById('rooms');
@@ -60,8 +67,26 @@
   // Exibe mensagens no chat
   // ---------------------------
   function appendMessage(item){
-    // Evita duplicação: verifica se a mensagem já existe
-    if([...messagesEl.children].some(c => c.dataset.id === item.id)) return;
+    appendMessages([item]);
+  }
+
+  // Insere várias mensagens com uma única atualização do DOM (e um scroll)
+  function appendMessages(items){
+    if(!items.length) return;
+    // Evita duplicação: ids já na tela
+    const frag = document.createDocumentFragment();
+    items.forEach(item => {
+      if(seenIds.has(item.id)) return;
+      seenIds.add(item.id);
+      frag.appendChild(renderMessage(item));
+    });
+    messagesEl.appendChild(frag);
+    messagesEl.scrollTop = messagesEl.scrollHeight;
+  }
+
+  function renderMessage(item){
+    // ObjectIds em hex têm o mesmo tamanho: comparação lexicográfica basta
+    if(item.id && (!lastMsgId || item.id > lastMsgId)) lastMsgId = item.id;
 
     const d = document.createElement('div');
     d.className = 'msg';
@@ -71,14 +96,19 @@
         <div class="metaRow">[${new Date(item.created_at).toLocaleTimeString()}] <strong>${item.username}</strong></div>
         <div class="bubble">${escapeHtml(item.content)}</div>
       </div>`;
-    messagesEl.appendChild(d);
-    messagesEl.scrollTop = messagesEl.scrollHeight;
+    return d;
   }
 
   function escapeHtml(unsafe) {
     return unsafe.replace(/[&<"'>]/g, m => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#039;'}[m]));
   }
 
+  function clearMessages(){
+    messagesEl.innerHTML = '';
+    seenIds.clear();
+    lastMsgId = null;
+  }
+
   function setStatus(s){
     statusEl.innerText = 'status: ' + s;
   }
@@ -91,14 +121,23 @@
     if(!user) return alert('Escolha um personagem no /');
 
     // Fecha WS antigo e limpa heartbeat
-    if(ws) { ws.close(); ws = null; }
+    if(reconnectTimer) { clearTimeout(reconnectTimer); reconnectTimer = null; }
+    if(ws) { ws.onclose = null; ws.close(); ws = null; }
     if(heartbeatInterval) { clearInterval(heartbeatInterval); heartbeatInterval = null; }
 
     const proto = location.protocol === 'https:' ? 'wss' : 'ws';
-    const url = `${proto}://${location.host}/ws/${encodeURIComponent(room)}`;
+    let url = `${proto}://${location.host}/ws/${encodeURIComponent(room)}`;
+    // batch=1: o servidor junta rajadas de mensagens num único frame;
+    // v=2: protocolo compacto (chaves curtas, usuários definidos uma vez)
+    const params = new URLSearchParams({ batch: '1', v: '2' });
+    users = new Map();
+    if(lastId) params.set('last_id', lastId);
+    if(lastMsgId) params.set('since_id', lastMsgId);
+    url += `?${params}`;
     ws = new WebSocket(url);
 
     ws.onopen = () => {
+      reconnectDelay = 1000;
       setStatus('conectado');
       roomTitle.innerText = `Sala: ${room}`;
       roomInfo.innerText = `Conectado como ${user.name}`;
@@ -108,27 +147,109 @@
           ws.send(JSON.stringify({ type: "heartbeat", username: user.name }));
         }
       }, 30000);
+
+      // Reenvia o que ficou sem ack; o servidor deduplica pelo client_msg_id
+      outbox.forEach(payload => ws.send(JSON.stringify(payload)));
     };
 
     ws.onmessage = (evt) => {
       try {
-        const data = JSON.parse(evt.data);
-        if(data.type === 'history'){
-          messagesEl.innerHTML = '';
-          (data.items || []).forEach(it => appendMessage(normalize(it)));
-        } else if(data.type === 'message'){
-          appendMessage(normalize(data.item));
-        }
+        const data = expandFrame(JSON.parse(evt.data));
+        if(data) handleFrame(data);
       } catch(e) { console.error("Erro ao processar WS:", e); }
     };
 
-    ws.onclose = () => {
+    ws.onclose = (evt) => {
       setStatus('desconectado');
       if(heartbeatInterval) { clearInterval(heartbeatInterval); heartbeatInterval = null; }
+      // Fechamentos pedidos pelo próprio cliente anulam onclose antes; aqui é
+      // queda, deploy (1001/1012) ou sobrecarga (1013): reconecta com backoff,
+      // mantendo lastId/lastMsgId para receber só a lacuna (delta)
+      scheduleReconnect(evt.code === 1013 ? 2000 : 0);
     };
     ws.onerror = () => setStatus('erro');
   }
 
+  function scheduleReconnect(minDelay){
+    if(reconnectTimer) return;
+    const delay = Math.max(minDelay, reconnectDelay) * (0.5 + Math.random() / 2);
+    reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+    reconnectTimer = setTimeout(() => { reconnectTimer = null; connectWS(); }, delay);
+  }
+
+  function handleFrame(data){
+    if(data.type === 'batch'){
+      // Rajada: mensagens consecutivas entram no DOM de uma vez, na ordem
+      let pending = [];
+      (data.items || []).forEach(f => {
+        if(f.type === 'message'){
+          pending.push(normalize(f.item));
+          trackId(f.sid);
+        } else {
+          appendMessages(pending);
+          pending = [];
+          handleFrame(f);
+        }
+      });
+      appendMessages(pending);
+    } else if(data.type === 'history'){
+      // delta: só a lacuna desde a última mensagem, mantém o que já está na tela
+      if(!data.delta) clearMessages();
+      appendMessages((data.items || []).map(normalize));
+      trackId(data.last_id);
+    } else if(data.type === 'message'){
+      appendMessage(normalize(data.item));
+      trackId(data.sid);
+    } else if(data.type === 'ack'){
+      // A mensagem chega pelo broadcast da sala; o ack só libera o reenvio
+      outbox.delete(data.client_msg_id);
+    } else if(data.type === 'error'){
+      if(data.client_msg_id) outbox.delete(data.client_msg_id);
+      console.warn('Erro do servidor:', data.detail);
+    } else if(data.type === 'resync'){
+      // Servidor descartou mensagens por lentidão: recarrega o histórico
+      connectWS();
+    }
+  }
+
+  // ---------------------------
+  // Protocolo v2 → formato v1
+  // ---------------------------
+  function expandItem(m){
+    const u = users.get(m.u) || { name: '?', avatar: null };
+    return {
+      id: m.i,
+      username: u.name,
+      avatar: u.avatar,
+      content: m.c,
+      created_at: m.ts ? new Date(m.ts).toISOString() : null
+    };
+  }
+
+  // Devolve o frame no formato v1; definições de usuários só atualizam a tabela
+  function expandFrame(f){
+    if(!f.t) return f; // controle (error, resync) ou v1
+    if(f.t === 'u'){
+      f.u.forEach(([id, name, avatar]) => users.set(id, { name, avatar }));
+      return null;
+    }
+    if(f.t === 'm') return { type: 'message', sid: f.s, item: expandItem(f.m) };
+    if(f.t === 'a') return { type: 'ack', client_msg_id: f.c, id: f.i };
+    if(f.t === 'h') return { type: 'history', last_id: f.l, delta: !!f.d, items: (f.m || []).map(expandItem) };
+    // em ordem: uma definição dentro do lote vale para os frames seguintes
+    if(f.t === 'b') return { type: 'batch', items: (f.f || []).map(expandFrame).filter(Boolean) };
+    return null;
+  }
+
+  // Guarda o maior id de stream visto ("ms-seq")
+  function trackId(id){
+    if(!id) return;
+    if(!lastId) { lastId = id; return; }
+    const [a, b] = id.split('-').map(Number);
+    const [c, d] = lastId.split('-').map(Number);
+    if(a > c || (a === c && b > d)) lastId = id;
+  }
+
   // Normaliza datas
   function normalize(item){
     if(item.created_at && typeof item.created_at === 'string'){
@@ -144,10 +265,16 @@
   // ---------------------------
   // Envia mensagem
   // ---------------------------
+  function newClientId(){
+    if(window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+  }
+
   sendBtn.onclick = () => {
     const text = inputEl.value.trim();
     if(!text || !ws || ws.readyState !== WebSocket.OPEN) return;
-    const payload = { username: user.name, content: text, avatar: user.avatar };
+    const payload = { username: user.name, content: text, avatar: user.avatar, client_msg_id: newClientId() };
+    outbox.set(payload.client_msg_id, payload);
     ws.send(JSON.stringify(payload));
     inputEl.value = '';
   };
@@ -158,7 +285,9 @@
   function joinRoom(r){
     localStorage.setItem('room', r);
     room = r;
-    messagesEl.innerHTML = '';
+    lastId = null;
+    outbox.clear();
+    clearMessages();
     connectWS();
   }
 
@@ -187,6 +316,15 @@
 
   backBtn.onclick = () => { window.location.href = '/index.html'; };
 
+  // Rede voltou: reconecta já, sem esperar o backoff, retomando do último
+  // id do stream (last_id) e da última mensagem (since_id)
+  window.addEventListener('online', () => {
+    if(room && (!ws || ws.readyState === WebSocket.CLOSED)) {
+      reconnectDelay = 1000;
+      connectWS();
+    }
+  });
+
   // ---------------------------
   // Inicialização
   // ---------------------------
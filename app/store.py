@@ -0,0 +1,254 @@
+# app/store.py
+"""
+Armazenamento das mensagens no MongoDB. Todo acesso a mensagens passa por
+aqui, para que o layout seja escolhido num lugar só (MESSAGE_STORAGE):
+
+- "documents": um documento por mensagem em `messages`;
+- "buckets": mensagens agrupadas por sala em `message_buckets`, até
+  MESSAGE_BUCKET_SIZE por documento, com os limites first_id/last_id e
+  start/end para navegar e expirar sem abrir os buckets.
+
+Em ambos a paginação é keyset por _id da mensagem (before_id/after_id).
+"""
+from contextlib import aclosing
+from datetime import datetime, timezone
+from itertools import groupby
+from typing import AsyncIterator, List, Optional
+import heapq
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .config import EXPORT_BATCH_SIZE, MESSAGE_BUCKET_SIZE, MESSAGE_STORAGE
+from .database import get_db
+
+MESSAGES = "messages"
+BUCKETS = "message_buckets"
+DUPLICATE_KEY = 11000
+
+# campos da mensagem guardados dentro do bucket (room fica no bucket)
+BUCKET_FIELDS = ("_id", "username", "avatar", "content", "created_at")
+
+
+def _utc(value):
+    # o Motor devolve datetimes sem timezone (UTC); os limites chegam com timezone
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _in_range(value, bounds: Optional[dict]) -> bool:
+    if not bounds:
+        return True
+    value = _utc(value)
+    bounds = {op: _utc(arg) for op, arg in bounds.items()}
+    if "$gt" in bounds and not value > bounds["$gt"]:
+        return False
+    if "$gte" in bounds and not value >= bounds["$gte"]:
+        return False
+    if "$lt" in bounds and not value < bounds["$lt"]:
+        return False
+    if "$lte" in bounds and not value <= bounds["$lte"]:
+        return False
+    return True
+
+
+# ---------------------------
+# Escrita
+# ---------------------------
+def _bucket_update(room: str, docs: List[dict]) -> UpdateOne:
+    """
+    Acrescenta `docs` ao bucket aberto da sala (ou cria um). $addToSet
+    torna a escrita idempotente: um retry não duplica a mensagem no bucket.
+    """
+    messages = [{k: d.get(k) for k in BUCKET_FIELDS} for d in docs]
+    ids = [m["_id"] for m in messages]
+    created = [m["created_at"] for m in messages]
+    return UpdateOne(
+        {"room": room, "count": {"$lte": MESSAGE_BUCKET_SIZE - len(docs)}},
+        {
+            "$addToSet": {"messages": {"$each": messages}},
+            "$inc": {"count": len(docs)},
+            "$min": {"first_id": min(ids), "start": min(created)},
+            "$max": {"last_id": max(ids), "end": max(created)},
+        },
+        upsert=True,
+    )
+
+
+def _bucket_chunks(docs: List[dict]) -> List[List[dict]]:
+    """Agrupa por sala em pedaços que cabem num bucket."""
+    chunks = []
+    ordered = sorted(docs, key=lambda d: d["room"])
+    for _, group in groupby(ordered, key=lambda d: d["room"]):
+        group = list(group)
+        for i in range(0, len(group), MESSAGE_BUCKET_SIZE):
+            chunks.append(group[i:i + MESSAGE_BUCKET_SIZE])
+    return chunks
+
+
+async def insert_message(doc: dict):
+    """Grava uma mensagem (caminho síncrono do envio)."""
+    if MESSAGE_STORAGE == "buckets":
+        await get_db()[BUCKETS].bulk_write([_bucket_update(doc["room"], [doc])])
+    else:
+        await get_db()[MESSAGES].insert_one(doc)
+
+
+async def write_messages(docs: List[dict]) -> List[dict]:
+    """
+    Grava um lote (write-behind). Devolve os documentos que falharam e
+    podem ser tentados de novo; chave duplicada conta como já gravado.
+    Erros que não são por documento (rede, etc.) são propagados.
+    """
+    if MESSAGE_STORAGE == "buckets":
+        chunks = _bucket_chunks(docs)
+        try:
+            await get_db()[BUCKETS].bulk_write(
+                [_bucket_update(c[0]["room"], c) for c in chunks], ordered=False
+            )
+            return []
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+            return [d for i, c in enumerate(chunks) if i in failed for d in c]
+
+    try:
+        await get_db()[MESSAGES].insert_many(docs, ordered=False)
+        return []
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        failed = {err["index"] for err in errors if err.get("code") != DUPLICATE_KEY}
+        return [d for i, d in enumerate(docs) if i in failed]
+
+
+# ---------------------------
+# Leitura
+# ---------------------------
+async def _bucket_messages(
+    room: str,
+    bounds: dict,
+    ascending: bool,
+    created: Optional[dict] = None,
+    batch_size: int = 0,
+) -> AsyncIterator[dict]:
+    """
+    Mensagens da sala em ordem estrita de _id a partir dos buckets.
+
+    Buckets gravados em paralelo podem se sobrepor; um heap segura as
+    mensagens até que nenhum bucket seguinte possa trazer uma anterior a
+    elas (memória limitada a poucos buckets). Duplicatas são puladas.
+    """
+    query: dict = {"room": room}
+    lower = bounds.get("$gt", bounds.get("$gte"))
+    upper = bounds.get("$lt", bounds.get("$lte"))
+    if lower is not None:
+        query["last_id"] = {"$gte": lower}
+    if upper is not None:
+        query["first_id"] = {"$lte": upper}
+    if created:
+        if "$gte" in created:
+            query["end"] = {"$gte": created["$gte"]}
+        if "$lt" in created:
+            query["start"] = {"$lt": created["$lt"]}
+    if ascending:
+        sort, edge_field = [("first_id", ASCENDING)], "first_id"
+
+        def key(oid: ObjectId) -> bytes:
+            return oid.binary
+    else:
+        sort, edge_field = [("last_id", DESCENDING)], "last_id"
+
+        def key(oid: ObjectId) -> bytes:
+            return bytes(255 - b for b in oid.binary)
+
+    cursor = get_db()[BUCKETS].find(query).sort(sort)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    heap: list = []
+    seq = 0
+    last = None
+    try:
+        async for bucket in cursor:
+            edge = key(bucket[edge_field])
+            # nenhum bucket seguinte tem mensagem antes de `edge`
+            while heap and heap[0][0] < edge:
+                m = heapq.heappop(heap)[2]
+                if m["_id"] != last:
+                    last = m["_id"]
+                    yield dict(m, room=room)
+            for m in bucket.get("messages", []):
+                if _in_range(m["_id"], bounds) and _in_range(m.get("created_at"), created):
+                    heapq.heappush(heap, (key(m["_id"]), seq, m))
+                    seq += 1
+        while heap:
+            m = heapq.heappop(heap)[2]
+            if m["_id"] != last:
+                last = m["_id"]
+                yield dict(m, room=room)
+    finally:
+        await cursor.close()
+
+
+async def iter_messages(
+    room: str,
+    bounds: Optional[dict] = None,
+    created: Optional[dict] = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> AsyncIterator[dict]:
+    """Todas as mensagens da sala no intervalo, em ordem crescente de _id."""
+    bounds = bounds or {}
+    if MESSAGE_STORAGE == "buckets":
+        async with aclosing(_bucket_messages(room, bounds, True, created, batch_size)) as messages:
+            async for m in messages:
+                yield m
+        return
+
+    query: dict = {"room": room}
+    if bounds:
+        query["_id"] = bounds
+    if created:
+        query["created_at"] = created
+    cursor = get_db()[MESSAGES].find(query).sort("_id", ASCENDING).batch_size(batch_size)
+    try:
+        async for doc in cursor:
+            yield doc
+    finally:
+        await cursor.close()
+
+
+async def fetch_messages(
+    room: str,
+    limit: int,
+    before_id: Optional[ObjectId] = None,
+    after_id: Optional[ObjectId] = None,
+) -> List[dict]:
+    """
+    Página de documentos da sala em ordem cronológica (keyset por _id).
+    before_id: mensagens anteriores (rolagem para trás);
+    after_id: mensagens posteriores (sincronização incremental).
+    """
+    bounds = {}
+    if before_id is not None:
+        bounds["$lt"] = before_id
+    if after_id is not None:
+        bounds["$gt"] = after_id
+    ascending = after_id is not None
+
+    if MESSAGE_STORAGE == "buckets":
+        docs = []
+        async with aclosing(_bucket_messages(room, bounds, ascending)) as messages:
+            async for m in messages:
+                docs.append(m)
+                if len(docs) >= limit:
+                    break
+    else:
+        query: dict = {"room": room}
+        if bounds:
+            query["_id"] = bounds
+        cursor = get_db()[MESSAGES].find(query).sort("_id", 1 if ascending else -1).limit(limit)
+        docs = [d async for d in cursor]
+
+    if not ascending:
+        docs.reverse()
+    return docs
@@ -0,0 +1,145 @@
+# app/streams.py
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
+
+from redis.crc import key_slot
+from redis.exceptions import RedisError
+
+from .config import (
+    PUBSUB_UNSUBSCRIBE_DELAY,
+    REDIS_CLUSTER,
+    ROOM_STREAM_BLOCK_MS,
+    ROOM_STREAM_CATCHUP_MAX,
+    ROOM_STREAM_CLUSTER_POLL_MS,
+    WS_SEND_QUEUE_MAX,
+)
+from .pubsub import MessageHandler, RoomFeed
+from .redis_client import RedisClient, get_pubsub_redis, get_redis, stream_key
+
+logger = logging.getLogger(__name__)
+
+# Entradas por XREAD: abaixo da fila de envio por conexão, para que uma
+# leitura de recuperação (após travamento do loop, erro ou polling no
+# Cluster) não encha sozinha a fila de um cliente saudável
+STREAM_READ_COUNT = max(1, min(500, WS_SEND_QUEUE_MAX // 2))
+
+
+def parse_stream_id(stream_id: str) -> Tuple[int, int]:
+    """Converte "ms-seq" em tupla comparável; ValueError se inválido."""
+    ms, _, seq = stream_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class RoomStreams(RoomFeed):
+    """
+    Consumo dos Redis Streams das salas com sockets locais via XREAD.
+
+    Ao ativar uma sala o cursor começa na última entrada existente, então
+    nada publicado depois do acquire se perde (no pior caso a primeira
+    leitura da sala nova espera o fim do BLOCK em andamento).
+
+    No Redis Cluster um XREAD só aceita chaves de um slot: as salas são
+    lidas por slot, sem BLOCK, num pipeline (um round trip por nó), com
+    pausa de `cluster_poll_ms` quando nada chegou.
+    """
+    def __init__(
+        self,
+        unsubscribe_delay: float = PUBSUB_UNSUBSCRIBE_DELAY,
+        block_ms: int = ROOM_STREAM_BLOCK_MS,
+        cluster_poll_ms: int = ROOM_STREAM_CLUSTER_POLL_MS,
+    ):
+        super().__init__(unsubscribe_delay)
+        self.block_ms = block_ms
+        self.cluster_poll_ms = cluster_poll_ms
+        # cursor (último id entregue) por chave de stream
+        self._cursors: Dict[str, str] = {}
+        self._key_rooms: Dict[str, str] = {}
+
+    async def _activate(self, room: str):
+        key = stream_key(room)
+        last = await get_redis().xrevrange(key, "+", "-", count=1)
+        self._cursors[key] = last[0][0] if last else "0-0"
+        self._key_rooms[key] = room
+
+    async def _deactivate(self, room: str):
+        key = stream_key(room)
+        self._cursors.pop(key, None)
+        self._key_rooms.pop(key, None)
+
+    async def _read(self, r: RedisClient) -> list:
+        if not REDIS_CLUSTER:
+            return await r.xread(dict(self._cursors), count=STREAM_READ_COUNT, block=self.block_ms)
+        slots: Dict[int, Dict[str, str]] = {}
+        for key, cursor in self._cursors.items():
+            slots.setdefault(key_slot(key.encode()), {})[key] = cursor
+        pipe = r.pipeline(transaction=False)
+        for streams in slots.values():
+            pipe.xread(streams, count=STREAM_READ_COUNT)
+        resp = [entry for res in await pipe.execute() for entry in res or []]
+        if not resp:
+            await asyncio.sleep(self.cluster_poll_ms / 1000)
+        return resp
+
+    async def listen(self, handler: MessageHandler):
+        """Lê as entradas novas e chama handler(room, data, stream_id)."""
+        # XREAD BLOCK segura a conexão: vai pelo cliente de leituras longas
+        r = get_pubsub_redis()
+        await self._ready.wait()
+        while True:
+            if not self._cursors:
+                await asyncio.sleep(self.block_ms / 1000)
+                continue
+            try:
+                resp = await self._read(r)
+            except RedisError:
+                logger.warning("Falha no XREAD, tentando novamente")
+                await asyncio.sleep(1)
+                continue
+
+            for key, entries in resp or []:
+                room = self._key_rooms.get(key)
+                if room is None:
+                    # sala desativada durante o BLOCK
+                    continue
+                for stream_id, fields in entries:
+                    self._cursors[key] = stream_id
+                    data = fields.get("m")
+                    if data:
+                        await handler(room, data, stream_id)
+                    # cede o loop entre entradas: as escritoras drenam as filas
+                    await asyncio.sleep(0)
+
+
+async def read_room_log(
+    room: str,
+    last_id: Optional[str] = None,
+    limit: int = 50,
+    catchup_max: int = ROOM_STREAM_CATCHUP_MAX,
+) -> Tuple[List[Tuple[str, str]], bool]:
+    """
+    Lê o histórico da sala no stream, em ordem cronológica.
+
+    Com `last_id` devolve só as entradas posteriores (delta=True), desde
+    que a lacuna caiba em `catchup_max` e não tenha sido aparada pelo
+    MAXLEN; caso contrário devolve as últimas `limit` entradas (delta=False).
+    """
+    r = get_redis()
+    key = stream_key(room)
+    if last_id:
+        try:
+            last = parse_stream_id(last_id)
+        except ValueError:
+            last = None
+        if last is not None:
+            pipe = r.pipeline(transaction=False)
+            pipe.xrange(key, f"({last_id}", "+", count=catchup_max + 1)
+            pipe.xrange(key, "-", "+", count=1)
+            gap, oldest = await pipe.execute()
+            trimmed = bool(oldest) and parse_stream_id(oldest[0][0]) > last
+            if len(gap) <= catchup_max and not trimmed:
+                return [(sid, f["m"]) for sid, f in gap], True
+
+    entries = await r.xrevrange(key, "+", "-", count=limit)
+    entries.reverse()
+    return [(sid, f["m"]) for sid, f in entries], False
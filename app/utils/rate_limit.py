@@ -1,23 +1,101 @@
-from app.redis_client import get_redis
+from collections import OrderedDict, deque
+from typing import Dict, NamedTuple
+import json
+import time
 
-# Janela de tempo em segundos e limite máximo de mensagens
-RATE_LIMIT_WINDOW = 60  # 1 minuto
-RATE_LIMIT_MAX = 5      # máximo de 5 mensagens por usuário por sala
+from app.config import (
+    RATE_LIMIT_REST_ALGORITHM,
+    RATE_LIMIT_REST_MAX,
+    RATE_LIMIT_REST_WINDOW,
+    RATE_LIMIT_ROOM_POLICIES,
+    RATE_LIMIT_WS_ALGORITHM,
+    RATE_LIMIT_WS_MAX,
+    RATE_LIMIT_WS_WINDOW,
+)
 
-async def check_rate_limit(room: str, username: str) -> bool:
+ALGORITHMS = ("sliding_window", "token_bucket")
+
+
+class RateLimitPolicy(NamedTuple):
+    """Política de rate limit: `limit` mensagens a cada `window` segundos."""
+    algorithm: str
+    limit: int
+    window: float
+
+    def describe(self) -> str:
+        return f"Rate limit: max {self.limit} msgs / {self.window:g}s"
+
+
+def _policy(algorithm: str, limit: int, window: float) -> RateLimitPolicy:
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Algoritmo de rate limit inválido: {algorithm}")
+    return RateLimitPolicy(algorithm, int(limit), float(window))
+
+
+# Política padrão por rota
+POLICIES: Dict[str, RateLimitPolicy] = {
+    "ws": _policy(RATE_LIMIT_WS_ALGORITHM, RATE_LIMIT_WS_MAX, RATE_LIMIT_WS_WINDOW),
+    "rest": _policy(RATE_LIMIT_REST_ALGORITHM, RATE_LIMIT_REST_MAX, RATE_LIMIT_REST_WINDOW),
+}
+
+# Sobrescritas por sala: {sala: {rota: política}}
+ROOM_POLICIES: Dict[str, Dict[str, RateLimitPolicy]] = {
+    room: {
+        route: _policy(
+            p.get("algorithm", POLICIES[route].algorithm),
+            p.get("limit", POLICIES[route].limit),
+            p.get("window", POLICIES[route].window),
+        )
+        for route, p in routes.items()
+    }
+    for room, routes in (json.loads(RATE_LIMIT_ROOM_POLICIES) if RATE_LIMIT_ROOM_POLICIES else {}).items()
+}
+
+
+def get_policy(route: str, room: str) -> RateLimitPolicy:
+    """Política efetiva da rota na sala."""
+    return ROOM_POLICIES.get(room, {}).get(route) or POLICIES[route]
+
+
+class LocalRateLimiter:
     """
-    Retorna True se o usuário puder enviar mensagem, False se excedeu.
-    Usa Redis para contar mensagens enviadas por usuário por sala.
+    Pré-checagem em memória, sem Redis.
+
+    Registra só os envios que o Redis aceitou, então o consumo local é
+    sempre menor ou igual ao global: se o limite local já estourou, o global
+    também, e o envio pode ser recusado sem round trip. Guarda no máximo
+    `max_keys` usuários (LRU).
     """
-    r = get_redis()
-    key = f"rl:{room}:{username}"
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._state: "OrderedDict[str, object]" = OrderedDict()
+
+    def allows(self, key: str, policy: RateLimitPolicy) -> bool:
+        state = self._state.get(key)
+        if state is None:
+            return True
+        now = time.monotonic()
+        if policy.algorithm == "token_bucket":
+            tokens, ts = state
+            return min(policy.limit, tokens + (now - ts) * policy.limit / policy.window) >= 1
+        while state and state[0] <= now - policy.window:
+            state.popleft()
+        return len(state) < policy.limit
 
-    # INCR é atômico, então múltiplos envios simultâneos não vão quebrar
-    val = await r.incr(key)
+    def record(self, key: str, policy: RateLimitPolicy):
+        now = time.monotonic()
+        state = self._state.get(key)
+        if policy.algorithm == "token_bucket":
+            tokens, ts = state if state is not None else (policy.limit, now)
+            tokens = min(policy.limit, tokens + (now - ts) * policy.limit / policy.window)
+            self._state[key] = (max(tokens - 1, 0), now)
+        else:
+            if state is None:
+                state = self._state[key] = deque()
+            state.append(now)
+        self._state.move_to_end(key)
+        while len(self._state) > self.max_keys:
+            self._state.popitem(last=False)
 
-    # Se é a primeira mensagem da janela, define TTL
-    if val == 1:
-        await r.expire(key, RATE_LIMIT_WINDOW)
 
-    # Retorna True se estiver dentro do limite, False caso contrário
-    return val <= RATE_LIMIT_MAX
+local_limiter = LocalRateLimiter()
@@ -1,55 +1,408 @@
-from typing import Dict, Set
+from typing import Deque, Dict, Iterable, Iterator, Optional, Set, Tuple, Union
+from collections import deque
 from fastapi import WebSocket
 import asyncio
+import logging
+import time
+
+from .codec import dumps
+from .config import (
+    WS_BATCH_MAX,
+    WS_BATCH_WINDOW,
+    WS_SEND_QUEUE_MAX,
+    WS_SEND_QUEUE_BURST,
+    WS_SLOW_CONSUMER_CLOSE_CODE,
+    WS_SLOW_CONSUMER_GRACE,
+    WS_SLOW_CONSUMER_POLICY,
+)
+from .metrics import BROADCAST_DROPPED, BROADCAST_SECONDS, BROADCAST_SEND_ERROR
+from .protocol import (
+    PROTOCOL_VERSIONS,
+    UsersFrame,
+    compact_ack_frame,
+    compact_batch_frame,
+    compact_message_frame,
+    users_frame,
+)
+from .pubsub import RoomFeed
+
+logger = logging.getLogger(__name__)
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Frame já serializado: str vai como texto, bytes como binário
+Frame = Union[str, bytes]
+
+
+def encode_frame(payload: dict) -> str:
+    """Serializa um payload uma única vez."""
+    return dumps(payload)
+
+
+def message_frame(item: Frame, stream_id: Optional[str] = None) -> str:
+    """
+    Envelopa um item já serializado (ex.: payload cru do Pub/Sub)
+    em {"type":"message","item":...} sem decodificar o JSON.
+    Com Redis Streams inclui o id da entrada em "sid".
+    """
+    if isinstance(item, (bytes, bytearray)):
+        item = item.decode()
+    if stream_id:
+        return '{"type":"message","sid":' + dumps(stream_id) + ',"item":' + item + "}"
+    return '{"type":"message","item":' + item + "}"
+
+
+def history_frame(items: Iterable[str], last_id: Optional[str] = None, delta: bool = False) -> str:
+    """
+    Monta {"type":"history","items":[...]} a partir de itens já serializados.
+    `last_id` é o cursor do stream para retomada; `delta` indica que os
+    itens complementam o que o cliente já tem.
+    """
+    head = '{"type":"history",'
+    if last_id:
+        head += '"last_id":' + dumps(last_id) + ","
+    if delta:
+        head += '"delta":true,'
+    return head + '"items":[' + ",".join(items) + "]}"
+
+
+def ack_frame(client_msg_id: str, msg_id: Optional[str]) -> str:
+    """Confirma ao remetente que o envio `client_msg_id` virou a mensagem `msg_id`."""
+    return encode_frame({"type": "ack", "client_msg_id": client_msg_id, "id": msg_id})
+
+
+def batch_frame(frames: Iterable[str]) -> str:
+    """Junta frames já serializados em {"type":"batch","items":[...]}."""
+    return '{"type":"batch","items":[' + ",".join(frames) + "]}"
+
+
+# Enviado no lugar do backlog descartado pela política "coalesce":
+# o cliente recarrega o histórico em vez de receber mensagens soltas.
+RESYNC_FRAME = encode_frame({"type": "resync"})
+
+
+class Connection:
+    """
+    Estado de envio de um WebSocket: fila de saída limitada + task escritora.
+    Com `batch` a escritora junta os frames de uma rajada num só.
+    No protocolo v2, `known_users` são os uids já definidos para o cliente.
+    `progress` é o último instante (monotonic) em que a escritora enviou algo
+    ou em que a fila deixou de estar vazia.
+    """
+    __slots__ = (
+        "ws", "room", "user", "queue", "wakeup", "task", "dropped", "closing",
+        "batch", "last_flush", "version", "known_users", "progress",
+    )
+
+    def __init__(self, ws: WebSocket, room: str, batch: bool = False, version: int = 1):
+        self.ws = ws
+        self.room = room
+        self.batch = batch
+        self.last_flush = 0.0
+        self.version = version
+        self.known_users: Set[int] = set()
+        # usuário informado pelo cliente (heartbeat/mensagem), para presença
+        self.user: Optional[str] = None
+        self.queue: Deque[Frame] = deque()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.closing = False
+        self.progress = time.monotonic()
+
 
 class WSManager:
     """
-    Gerencia conexões WebSocket por sala, prevenindo duplicação de envio.
+    Gerencia conexões WebSocket por sala.
+
+    Cada conexão tem sua própria fila de saída e uma task que escreve no
+    socket; broadcast_message apenas enfileira e nunca espera um cliente lento.
+    Se `subscriptions` for informado, cada socket local mantém a inscrição
+    Pub/Sub da sua sala.
+
+    Conexões em modo lote recebem no máximo um frame por `batch_window`
+    segundos: o que chegar nesse intervalo (até `batch_max` frames) vai
+    num único {"type":"batch"}. Mensagem isolada sai na hora.
+
+    A política de consumidor lento só é aplicada quando a fila está cheia
+    e a escritora não envia nada há `slow_grace` segundos; uma escritora
+    que está progredindo absorve rajadas até `queue_max * queue_burst`.
     """
-    def __init__(self):
+    def __init__(
+        self,
+        queue_max: int = WS_SEND_QUEUE_MAX,
+        slow_policy: str = WS_SLOW_CONSUMER_POLICY,
+        close_code: int = WS_SLOW_CONSUMER_CLOSE_CODE,
+        subscriptions: Optional[RoomFeed] = None,
+        batch_window: float = WS_BATCH_WINDOW,
+        batch_max: int = WS_BATCH_MAX,
+        slow_grace: float = WS_SLOW_CONSUMER_GRACE,
+        queue_burst: int = WS_SEND_QUEUE_BURST,
+    ):
+        if slow_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Política inválida para consumidor lento: {slow_policy}")
+        self.queue_max = max(1, queue_max)
+        self.slow_policy = slow_policy
+        self.close_code = close_code
+        self.subscriptions = subscriptions
+        self.batch_window = batch_window
+        self.batch_max = max(1, batch_max)
+        self.slow_grace = slow_grace
+        self.queue_hard_max = self.queue_max * max(1, queue_burst)
         # rooms: dict { room_name: set of WebSockets }
         self.rooms: Dict[str, Set[WebSocket]] = {}
-        # locks por sala para evitar envio simultâneo que cause duplicação
-        self._locks: Dict[str, asyncio.Lock] = {}
+        self._conns: Dict[WebSocket, Connection] = {}
+        # tasks de fechamento em andamento (mantém referência até terminarem)
+        self._closing: Set[asyncio.Task] = set()
 
-    async def connect(self, room: str, ws: WebSocket):
+    async def connect(self, room: str, ws: WebSocket, batch: bool = False, version: int = 1):
         """
-        Aceita o WebSocket e adiciona na sala.
-        Não adiciona duplicado.
+        Aceita o WebSocket, adiciona na sala e inicia sua task escritora.
+        Não adiciona duplicado. `batch` liga o envio em lotes e `version`
+        escolhe o protocolo (1 = JSON completo, 2 = compacto).
         """
+        if version not in PROTOCOL_VERSIONS:
+            raise ValueError(f"Versão de protocolo inválida: {version}")
         await ws.accept()
-        if room not in self.rooms:
-            self.rooms[room] = set()
-            self._locks[room] = asyncio.Lock()
-        if ws not in self.rooms[room]:
-            self.rooms[room].add(ws)
+        if ws in self._conns:
+            return
+        if self.subscriptions is not None:
+            await self.subscriptions.acquire(room)
+        conn = Connection(ws, room, batch, version)
+        conn.task = asyncio.create_task(self._writer(conn))
+        self._conns[ws] = conn
+        self.rooms.setdefault(room, set()).add(ws)
+
+    def connection_count(self, room: Optional[str] = None) -> int:
+        """WebSockets abertos no nó, ou só na sala informada."""
+        if room is None:
+            return len(self._conns)
+        return len(self.rooms.get(room, ()))
 
     def disconnect(self, room: str, ws: WebSocket):
         """
-        Remove WebSocket da sala.
+        Remove WebSocket da sala e encerra sua task escritora.
         """
+        conn = self._conns.pop(ws, None)
+        if conn is None:
+            return
+        if conn.task and conn.task is not asyncio.current_task():
+            conn.task.cancel()
+        if self.subscriptions is not None:
+            self.subscriptions.release(conn.room)
         conns = self.rooms.get(room)
         if conns and ws in conns:
             conns.remove(ws)
             if not conns:
-                # remove a sala vazia e o lock
+                # remove a sala vazia
                 self.rooms.pop(room, None)
-                self._locks.pop(room, None)
 
-    async def broadcast(self, room: str, payload: dict):
+    def send(self, ws: WebSocket, payload: dict) -> bool:
+        """
+        Enfileira uma mensagem para um único WebSocket (histórico, erros, eco).
+        Retorna False se a conexão não existe mais ou a mensagem foi descartada.
+        """
+        return self.send_frame(ws, encode_frame(payload))
+
+    def send_frame(self, ws: WebSocket, frame: Frame) -> bool:
+        """Como send, mas com o frame já serializado."""
+        conn = self._conns.get(ws)
+        if conn is None:
+            return False
+        return self._enqueue(conn, frame)
+
+    def send_item(self, ws: WebSocket, item: dict) -> bool:
+        """Envia um item de mensagem no protocolo da conexão (eco ao remetente)."""
+        conn = self._conns.get(ws)
+        if conn is None:
+            return False
+        if conn.version == 2:
+            return self._enqueue(conn, compact_message_frame(item))
+        return self._enqueue(conn, encode_frame({"type": "message", "item": item}))
+
+    def send_ack(self, ws: WebSocket, client_msg_id: str, msg_id: Optional[str]) -> bool:
         """
-        Envia uma mensagem para todos os WebSockets da sala,
-        usando lock para evitar envio simultâneo que gere duplicação.
+        Confirma um envio com client_msg_id. Substitui o eco: o cliente já
+        mostra a mensagem e a recebe de novo pelo broadcast da sala.
         """
-        if room not in self.rooms:
+        conn = self._conns.get(ws)
+        if conn is None:
+            return False
+        if conn.version == 2:
+            return self._enqueue(conn, compact_ack_frame(client_msg_id, msg_id))
+        return self._enqueue(conn, ack_frame(client_msg_id, msg_id))
+
+    async def broadcast_message(self, room: str, item: str, stream_id: Optional[str] = None):
+        """
+        Fan-out de um item já serializado (payload do Pub/Sub/Streams).
+        Cada formato é montado no máximo uma vez, só se houver conexões nele.
+        """
+        conns = self.rooms.get(room)
+        if not conns:
             return
-        lock = self._locks.get(room)
-        async with lock:
-            to_remove = []
-            for ws in list(self.rooms[room]):
-                try:
-                    await ws.send_json(payload)
-                except Exception:
-                    to_remove.append(ws)
-            for ws in to_remove:
-                self.disconnect(room, ws)
+        start = time.perf_counter()
+        frames: Dict[int, Frame] = {}
+        for ws in list(conns):
+            conn = self._conns.get(ws)
+            if conn is None:
+                continue
+            frame = frames.get(conn.version)
+            if frame is None:
+                if conn.version == 2:
+                    frame = compact_message_frame(item, stream_id)
+                else:
+                    frame = message_frame(item, stream_id)
+                frames[conn.version] = frame
+            self._enqueue(conn, frame)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    def set_user(self, ws: WebSocket, username: str):
+        """Associa o usuário ao socket; ele fica online enquanto o socket viver."""
+        conn = self._conns.get(ws)
+        if conn is not None:
+            conn.user = username
+
+    def live_users(self) -> Iterator[Tuple[str, str]]:
+        """Pares (sala, usuário) dos sockets abertos neste nó."""
+        for conn in list(self._conns.values()):
+            if conn.user:
+                yield conn.room, conn.user
+
+    # ---------------------------
+    # Métricas
+    # ---------------------------
+    def queue_depth(self, room: str) -> int:
+        """Total de mensagens aguardando envio na sala."""
+        return sum(len(c.queue) for c in self._room_conns(room))
+
+    def stats(self) -> Dict[str, dict]:
+        """Conexões, profundidade de fila e descartes por sala."""
+        out = {}
+        for room in list(self.rooms):
+            conns = self._room_conns(room)
+            depths = [len(c.queue) for c in conns]
+            out[room] = {
+                "connections": len(conns),
+                "queued": sum(depths),
+                "max_queued": max(depths, default=0),
+                "dropped": sum(c.dropped for c in conns),
+            }
+        return out
+
+    # ---------------------------
+    # Internos
+    # ---------------------------
+    def _room_conns(self, room: str):
+        conns = (self._conns.get(ws) for ws in self.rooms.get(room, ()))
+        return [c for c in conns if c is not None]
+
+    def _enqueue(self, conn: Connection, frame: Frame) -> bool:
+        """
+        Aplica a política de consumidor lento quando a fila está cheia e a
+        escritora ficou para trás (ou a fila passou do limite de rajada).
+        """
+        if conn.closing:
+            return False
+        queue = conn.queue
+        if not queue:
+            # escritora ociosa até agora: o atraso conta a partir daqui
+            conn.progress = time.monotonic()
+        uids = getattr(frame, "uids", None)
+        if uids and not uids <= conn.known_users:
+            # v2: define os usuários novos antes do frame que os referencia
+            missing = uids - conn.known_users
+            conn.known_users |= missing
+            queue.append(users_frame({uid: frame.users[uid] for uid in missing}))
+        if len(queue) >= self.queue_max and (
+            len(queue) >= self.queue_hard_max
+            or time.monotonic() - conn.progress > self.slow_grace
+        ):
+            conn.dropped += 1
+            BROADCAST_DROPPED.inc()
+            if self.slow_policy == "disconnect":
+                self._evict(conn)
+                return False
+            if self.slow_policy == "coalesce":
+                # troca todo o backlog (e a mensagem atual) por um único resync
+                queue.clear()
+                conn.known_users.clear()
+                queue.append(RESYNC_FRAME)
+                conn.wakeup.set()
+                return False
+            self._drop_oldest(queue)
+        queue.append(frame)
+        conn.wakeup.set()
+        return True
+
+    async def _writer(self, conn: Connection):
+        """Escreve no socket, em ordem, o que estiver na fila da conexão."""
+        queue = conn.queue
+        ws = conn.ws
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                while not queue:
+                    conn.wakeup.clear()
+                    await conn.wakeup.wait()
+                if conn.batch:
+                    # acumula até fechar a janela desde o último envio
+                    delay = conn.last_flush + self.batch_window - loop.time()
+                    if delay > 0 and len(queue) < self.batch_max:
+                        await asyncio.sleep(delay)
+                        if not queue:
+                            continue
+                    frame = self._take_batch(conn)
+                    conn.last_flush = loop.time()
+                else:
+                    frame = queue.popleft()
+                if isinstance(frame, str):
+                    await ws.send_text(frame)
+                else:
+                    await ws.send_bytes(frame)
+                conn.progress = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # socket quebrado: o handler da sala recebe o disconnect depois
+            BROADCAST_SEND_ERROR.inc()
+            self.disconnect(conn.room, conn.ws)
+
+    @staticmethod
+    def _drop_oldest(queue: Deque[Frame]):
+        """Descarta o frame mais antigo, preservando definições de usuários."""
+        for i, frame in enumerate(queue):
+            if not isinstance(frame, UsersFrame):
+                del queue[i]
+                return
+
+    def _take_batch(self, conn: Connection) -> Frame:
+        """Retira até batch_max frames de texto; um só sai sem envelope."""
+        queue = conn.queue
+        if not isinstance(queue[0], str):
+            return queue.popleft()
+        frames = []
+        while queue and len(frames) < self.batch_max and isinstance(queue[0], str):
+            frames.append(queue.popleft())
+        if len(frames) == 1:
+            return frames[0]
+        if conn.version == 2:
+            return compact_batch_frame(frames)
+        return batch_frame(frames)
+
+    def _evict(self, conn: Connection):
+        """Desconecta um consumidor lento com o close code configurado."""
+        conn.closing = True
+        conn.queue.clear()
+        logger.warning("WebSocket lento desconectado da sala %s", conn.room)
+        self.disconnect(conn.room, conn.ws)
+        task = asyncio.create_task(self._close(conn))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, conn: Connection):
+        if conn.task:
+            await asyncio.gather(conn.task, return_exceptions=True)
+        try:
+            await conn.ws.close(code=self.close_code)
+        except Exception:
+            pass
@@ -0,0 +1,4 @@
+"""
+Benchmark do servidor de chat contra stand-ins locais (fakeredis e um
+MongoDB em memória). Uso: python -m bench.run --help
+"""
@@ -0,0 +1,185 @@
+# bench/fakes.py
+"""
+Stand-ins em memória para o benchmark: um "Motor" mínimo com o que o app
+usa (find/sort/limit, find_one, insert_one/insert_many, create_indexes,
+explain) e o FakeAsyncRedis do fakeredis, com Pub/Sub, Streams e Lua.
+"""
+from typing import Any, Dict, List, Optional
+import bisect
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for field, cond in query.items():
+        value = doc.get(field)
+        if isinstance(cond, dict):
+            for op, arg in cond.items():
+                if value is None:
+                    return False
+                if op == "$gt" and not value > arg:
+                    return False
+                if op == "$gte" and not value >= arg:
+                    return False
+                if op == "$lt" and not value < arg:
+                    return False
+                if op == "$lte" and not value <= arg:
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return dict(doc)
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+
+class FakeCursor:
+    def __init__(self, coll: "FakeCollection", query: dict, projection: Optional[dict]):
+        self._coll = coll
+        self._query = query
+        self._projection = projection
+        self._sort: Optional[tuple] = None
+        self._limit = 0
+
+    def sort(self, key, direction: int = 1):
+        if isinstance(key, list):
+            key, direction = key[0]
+        self._sort = (key, direction)
+        return self
+
+    def limit(self, n: int):
+        self._limit = n
+        return self
+
+    def batch_size(self, n: int):
+        return self
+
+    async def close(self):
+        pass
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+
+    async def to_list(self, length: Optional[int] = None):
+        docs = [d async for d in self]
+        return docs[:length] if length else docs
+
+    def _docs(self) -> List[dict]:
+        docs = self._coll._candidates(self._query)
+        key, direction = self._sort or ("_id", 1)
+        if key == "_id" and self._coll._ordered(self._query):
+            # candidatos já em ordem de _id: corta sem ordenar tudo
+            if direction < 0:
+                docs = docs[::-1]
+        else:
+            docs = sorted(docs, key=lambda d: d.get(key), reverse=direction < 0)
+        out = []
+        for d in docs:
+            if _matches(d, self._query):
+                out.append(_project(d, self._projection))
+                if self._limit and len(out) >= self._limit:
+                    break
+        return out
+
+    def __aiter__(self):
+        async def gen():
+            for d in self._docs():
+                yield d
+        return gen()
+
+
+class FakeCollection:
+    """Coleção em memória; documentos com "room" ficam indexados por sala e _id."""
+    def __init__(self, name: str):
+        self.name = name
+        self._docs: Dict[Any, dict] = {}
+        self._by_room: Dict[str, List[ObjectId]] = {}
+        self._unique: List[str] = []
+
+    def _candidates(self, query: dict) -> List[dict]:
+        room = query.get("room")
+        if isinstance(room, str) and self._by_room:
+            return [self._docs[i] for i in self._by_room.get(room, [])]
+        return sorted(self._docs.values(), key=lambda d: str(d["_id"]))
+
+    def _ordered(self, query: dict) -> bool:
+        return isinstance(query.get("room"), str) and bool(self._by_room)
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> FakeCursor:
+        return FakeCursor(self, query or {}, projection)
+
+    async def find_one(self, query: dict, projection: Optional[dict] = None):
+        async for d in self.find(query, projection).limit(1):
+            return d
+        return None
+
+    def _insert(self, doc: dict):
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError("duplicate _id", 11000)
+        for field in self._unique:
+            if any(d.get(field) == doc.get(field) for d in self._docs.values()):
+                raise DuplicateKeyError(f"duplicate {field}", 11000)
+        self._docs[doc["_id"]] = doc
+        room = doc.get("room")
+        if isinstance(room, str) and isinstance(doc["_id"], ObjectId):
+            bisect.insort(self._by_room.setdefault(room, []), doc["_id"])
+
+    async def insert_one(self, doc: dict):
+        self._insert(doc)
+
+        class Result:
+            inserted_id = doc["_id"]
+        return Result
+
+    async def insert_many(self, docs: List[dict], ordered: bool = True):
+        for doc in docs:
+            try:
+                self._insert(doc)
+            except DuplicateKeyError:
+                if ordered:
+                    raise
+
+    async def create_indexes(self, models):
+        for model in models:
+            spec = model.document
+            if spec.get("unique"):
+                self._unique.extend(spec["key"].keys())
+
+    async def count_documents(self, query: dict) -> int:
+        return sum(1 for d in self._candidates(query) if _matches(d, query))
+
+
+class FakeDatabase:
+    def __init__(self):
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name)
+        return self._collections[name]
+
+
+class FakeMongoClient:
+    def __init__(self):
+        self._dbs: Dict[str, FakeDatabase] = {}
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        return self._dbs.setdefault(name, FakeDatabase())
+
+
+def install():
+    """Troca os clientes Redis e MongoDB do app pelos stand-ins."""
+    import fakeredis
+
+    from app import database, redis_client
+
+    database._client = FakeMongoClient()
+    # um só servidor em memória para os dois clientes (comandos e Pub/Sub);
+    # o pool do fakeredis não bloqueia, então precisa comportar todos os remetentes
+    fake = fakeredis.FakeAsyncRedis(decode_responses=True, max_connections=10000)
+    redis_client._redis = redis_client._pubsub_redis = fake
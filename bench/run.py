@@ -0,0 +1,372 @@
+# bench/run.py
+"""
+Benchmark de carga: sobe bench.server num subprocesso, conecta milhares
+de clientes WebSocket distribuídos entre salas e mede
+
+- latência do frame "history" na conexão;
+- memória (RSS do servidor) por conexão;
+- vazão e latência fim a fim do fan-out (envio → entrega nos outros
+  sockets da sala), com envios por WebSocket ou pelo POST REST.
+
+O resultado sai em JSON (stdout ou --output) para comparar entre commits:
+
+    python -m bench.run --clients 2000 --rooms 50 --distribution zipf --output bench.json
+"""
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TAG = "bench"
+
+
+# ---------------------------
+# Estatística / ambiente
+# ---------------------------
+def percentiles(samples: List[float]) -> dict:
+    """p50/p90/p99/max em ms (amostras em segundos)."""
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+
+    def at(q: float) -> float:
+        return round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 3)
+
+    return {
+        "count": len(s),
+        "mean": round(sum(s) / len(s) * 1000, 3),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": round(s[-1] * 1000, 3),
+    }
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """RSS do processo via /proc (só Linux)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def raise_nofile_limit():
+    """Milhares de sockets precisam de mais descritores que o padrão."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def room_sizes(clients: int, rooms: int, distribution: str, seed: int) -> List[int]:
+    """Quantos clientes vão para cada sala."""
+    rng = random.Random(seed)
+    if distribution == "single":
+        return [clients]
+    if distribution == "uniform":
+        weights = [1.0] * rooms
+    else:
+        # zipf: poucas salas grandes e uma cauda longa de salas pequenas
+        weights = [1.0 / (i + 1) for i in range(rooms)]
+    sizes = [0] * rooms
+    for i in rng.choices(range(rooms), weights=weights, k=clients):
+        sizes[i] += 1
+    return [n for n in sizes if n]
+
+
+# ---------------------------
+# Clientes
+# ---------------------------
+class Client:
+    __slots__ = ("idx", "room", "query", "ws", "latencies", "received", "reader")
+
+    def __init__(self, idx: int, room: str, query: str = ""):
+        self.idx = idx
+        self.room = room
+        self.query = query
+        self.ws = None
+        self.latencies: List[float] = []
+        self.received = 0
+        self.reader: Optional[asyncio.Task] = None
+
+    async def connect(self, base: str) -> float:
+        """Conecta e espera o frame de histórico; devolve a latência."""
+        start = time.perf_counter()
+        self.ws = await websockets.connect(f"{base}/ws/{self.room}{self.query}", max_queue=None, open_timeout=60)
+        while True:
+            frame = json.loads(await self.ws.recv())
+            if frame.get("type") == "history" or frame.get("t") == "h":
+                return time.perf_counter() - start
+
+    def on_item(self, item: dict):
+        # v1 traz "content"; o protocolo compacto (v2), "c"
+        parts = str(item.get("content", item.get("c", ""))).split("|")
+        # só mensagens do benchmark enviadas por outro cliente (ignora o eco)
+        if len(parts) == 3 and parts[0] == TAG and parts[1] != str(self.idx):
+            self.received += 1
+            self.latencies.append(time.perf_counter() - int(parts[2]) / 1e9)
+
+    async def read(self):
+        try:
+            async for raw in self.ws:
+                frame = json.loads(raw)
+                kind = frame.get("type") or frame.get("t")
+                if kind in ("message", "m"):
+                    self.on_item(frame.get("item") or frame.get("m") or {})
+                elif kind in ("batch", "b"):
+                    for sub in frame.get("items") or frame.get("f") or []:
+                        if sub.get("type") == "message" or sub.get("t") == "m":
+                            self.on_item(sub.get("item") or sub.get("m") or {})
+        except websockets.ConnectionClosed:
+            pass
+
+    def payload(self) -> dict:
+        return {
+            "username": f"u{self.idx}",
+            "content": f"{TAG}|{self.idx}|{time.perf_counter_ns()}",
+        }
+
+
+async def http_post(reader, writer, host: str, path: str, body: dict) -> int:
+    """POST HTTP/1.1 com keep-alive sobre um stream já aberto; devolve o status."""
+    data = json.dumps(body).encode()
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+# ---------------------------
+# Fases
+# ---------------------------
+async def wait_server(host: str, port: int, proc: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("bench.server terminou durante o startup")
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError("bench.server não respondeu")
+
+
+async def connect_all(clients: List[Client], base: str, concurrency: int) -> List[float]:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(c: Client) -> float:
+        async with sem:
+            return await c.connect(base)
+
+    return await asyncio.gather(*(one(c) for c in clients))
+
+
+async def send_phase(
+    senders: List[Client],
+    args: argparse.Namespace,
+) -> int:
+    """Cada remetente envia em ritmo fixo (`--rate` msgs/s) por `--duration` s."""
+    interval = 1.0 / args.rate
+    deadline = time.perf_counter() + args.duration
+    sent = 0
+
+    async def ws_sender(c: Client):
+        nonlocal sent
+        await asyncio.sleep(random.random() * interval)
+        while time.perf_counter() < deadline:
+            await c.ws.send(json.dumps(c.payload()))
+            sent += 1
+            await asyncio.sleep(interval)
+
+    async def rest_sender(c: Client):
+        nonlocal sent
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        try:
+            await asyncio.sleep(random.random() * interval)
+            while time.perf_counter() < deadline:
+                status = await http_post(reader, writer, args.host, f"/rooms/{c.room}/messages", c.payload())
+                if status == 201:
+                    sent += 1
+                await asyncio.sleep(interval)
+        finally:
+            writer.close()
+
+    sender = rest_sender if args.via == "rest" else ws_sender
+    await asyncio.gather(*(sender(c) for c in senders))
+    return sent
+
+
+async def fetch_stats(host: str, port: int) -> Optional[dict]:
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(f"GET /ws/stats HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        raw = await reader.read()
+        writer.close()
+        return json.loads(raw.split(b"\r\n\r\n", 1)[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    raise_nofile_limit()
+    rng = random.Random(args.seed)
+    sizes = room_sizes(args.clients, args.rooms, args.distribution, args.seed)
+    params = []
+    if args.batch:
+        params.append("batch=1")
+    if args.protocol == 2:
+        params.append("v=2")
+    query = "?" + "&".join(params) if params else ""
+    clients: List[Client] = []
+    for r, size in enumerate(sizes):
+        clients.extend(Client(len(clients) + i, f"{TAG}-{r}", query) for i in range(size))
+
+    cmd = [sys.executable, "-m", "bench.server", "--host", args.host, "--port", str(args.port), "--backend", args.backend]
+    if args.write_behind:
+        cmd.append("--write-behind")
+    proc = subprocess.Popen(cmd, cwd=ROOT)
+    try:
+        await wait_server(args.host, args.port, proc)
+        base = f"ws://{args.host}:{args.port}"
+        rss_before = rss_bytes(proc.pid)
+
+        t0 = time.perf_counter()
+        history = await connect_all(clients, base, args.connect_concurrency)
+        connect_time = time.perf_counter() - t0
+        await asyncio.sleep(1)
+        rss_after = rss_bytes(proc.pid)
+
+        for c in clients:
+            c.reader = asyncio.create_task(c.read())
+
+        # remetentes: uma fração dos clientes de cada sala (ao menos um)
+        by_room: Dict[str, List[Client]] = {}
+        for c in clients:
+            by_room.setdefault(c.room, []).append(c)
+        senders = []
+        for members in by_room.values():
+            k = max(1, int(len(members) * args.sender_fraction))
+            senders.extend(rng.sample(members, k))
+
+        t0 = time.perf_counter()
+        sent = await send_phase(senders, args)
+        send_time = time.perf_counter() - t0
+        await asyncio.sleep(args.drain)
+        stats = await fetch_stats(args.host, args.port)
+
+        for c in clients:
+            await c.ws.close()
+        await asyncio.gather(*(c.reader for c in clients), return_exceptions=True)
+
+        latencies = [x for c in clients for x in c.latencies]
+        delivered = sum(c.received for c in clients)
+        # entregas esperadas: cada envio vai aos outros membros da sala
+        fanout = sum(len(by_room[c.room]) - 1 for c in senders) / max(1, len(senders))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    per_conn = None
+    if rss_before is not None and rss_after is not None:
+        per_conn = int((rss_after - rss_before) / max(1, len(clients)))
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "rooms": {"count": len(sizes), "largest": max(sizes), "smallest": min(sizes)},
+        "connect": {
+            "clients": len(clients),
+            "seconds": round(connect_time, 3),
+            "history_latency_ms": percentiles(history),
+        },
+        "memory": {
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "per_connection_bytes": per_conn,
+        },
+        "fanout": {
+            "senders": len(senders),
+            "sent": sent,
+            "sent_per_sec": round(sent / send_time, 1) if send_time else None,
+            "delivered": delivered,
+            "expected_approx": int(sent * fanout),
+            "delivered_per_sec": round(delivered / send_time, 1) if send_time else None,
+            "latency_ms": percentiles(latencies),
+        },
+        "server_stats": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga do servidor de chat")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--distribution", choices=["uniform", "zipf", "single"], default="zipf")
+    parser.add_argument("--sender-fraction", type=float, default=0.1, help="fração de remetentes por sala")
+    parser.add_argument("--rate", type=float, default=1.0, help="msgs/s por remetente")
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos de envio")
+    parser.add_argument("--drain", type=float, default=2.0, help="espera pelas entregas após os envios")
+    parser.add_argument("--via", choices=["ws", "rest"], default="ws")
+    parser.add_argument("--backend", choices=["pubsub", "stream"], default="pubsub")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--batch", action="store_true", help="clientes pedem frames em lote (?batch=1)")
+    parser.add_argument("--protocol", type=int, choices=[1, 2], default=1, help="versão do protocolo (2 = compacto)")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="arquivo JSON de saída (padrão: stdout)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# bench/server.py
+"""
+Sobe o app com os stand-ins de bench.fakes, num processo só dele (a
+memória por conexão é medida pelo RSS deste processo).
+
+    python -m bench.server --port 8765 [--backend pubsub|stream]
+"""
+import argparse
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor do benchmark (Redis e MongoDB em memória)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--backend", choices=["pubsub", "stream"], default="pubsub")
+    parser.add_argument("--write-behind", action="store_true")
+    args = parser.parse_args()
+
+    # a config é lida no import do app: ajusta o ambiente antes
+    os.environ.setdefault("MONGO_URL", "mongodb://bench")
+    os.environ["MONGO_INDEX_CHECK"] = "off"
+    os.environ["ROOM_LOG_BACKEND"] = args.backend
+    os.environ["MESSAGE_WRITE_BEHIND"] = "1" if args.write_behind else "0"
+    # o benchmark mede o servidor, não o rate limit
+    os.environ.setdefault("RATE_LIMIT_WS_MAX", "1000000")
+    os.environ.setdefault("RATE_LIMIT_REST_MAX", "1000000")
+    # mede o nó sem recusar carga (o controle de admissão pode ser ligado pelo ambiente)
+    os.environ.setdefault("ADMISSION_LOOP_LAG_MAX", "0")
+    os.environ.setdefault("ADMISSION_INFLIGHT_MAX", "0")
+
+    from . import fakes
+    fakes.install()
+
+    import uvicorn
+    from app.main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", ws_per_message_deflate=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# tests/test_export.py
+from datetime import datetime, timedelta
+import asyncio
+
+from bson import ObjectId
+
+from app import store
+from app.codec import loads
+from app.export import export_lines
+
+
+class _Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    async def close(self):
+        pass
+
+    def __aiter__(self):
+        async def gen():
+            for d in self._docs:
+                yield d
+        return gen()
+
+
+class _Buckets:
+    """Coleção de buckets que devolve tudo; o filtro fino é o do store."""
+    def __init__(self, docs):
+        self._docs = docs
+
+    def find(self, query):
+        return _Cursor(self._docs)
+
+
+def _message(created: datetime) -> dict:
+    # como o Motor devolve: datetime sem timezone, em UTC
+    return {
+        "_id": ObjectId.from_datetime(created),
+        "username": "ana",
+        "avatar": None,
+        "content": created.isoformat(),
+        "created_at": created,
+    }
+
+
+def test_bucket_export_with_time_range(monkeypatch):
+    base = datetime(2024, 5, 1, 12, 0, 0)
+    messages = [_message(base + timedelta(minutes=i)) for i in range(5)]
+    bucket = {
+        "room": "geral",
+        "first_id": messages[0]["_id"],
+        "last_id": messages[-1]["_id"],
+        "start": messages[0]["created_at"],
+        "end": messages[-1]["created_at"],
+        "messages": messages,
+    }
+    monkeypatch.setattr(store, "MESSAGE_STORAGE", "buckets")
+    monkeypatch.setattr(store, "get_db", lambda: {store.BUCKETS: _Buckets([bucket])})
+
+    async def collect():
+        since = base + timedelta(minutes=1)
+        until = base + timedelta(minutes=3)
+        return [loads(line) async for line in export_lines("geral", since=since, until=until)]
+
+    items = asyncio.run(collect())
+    assert [i["id"] for i in items] == [str(m["_id"]) for m in messages[1:3]]
+    assert all(i["room"] == "geral" for i in items)